@@ -0,0 +1,155 @@
+"""
+Analytics of user's habits for the stats screen. All completions of the user are loaded in one query
+as day numbers (date ordinals) and turned into sorted period indexes of every habit, then completion
+rates, streaks, weekdays and trends are computed with NumPy array operations. Without NumPy
+(analytics extra) the same numbers are computed in pure Python, just slower on long histories.
+"""
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import date, timedelta
+from itertools import chain
+from typing import NamedTuple, Sequence
+from sqlalchemy import Date, literal, select
+
+from habbiton.models.habit import Habit, HabitCompletion
+from habbiton.periods import PERIODS, period_key, first_full_period, local_today
+from habbiton.streaks import Streaks
+from habbiton.uow import scoped_session
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Days of the recent consistency window, the trend compares it with the same number of days before it
+WINDOW_DAYS = 28
+#Ordinal of the first day of datetime64, NumPy's dates count days from it
+EPOCH = date(1970, 1, 1).toordinal()
+
+class HabitStats(NamedTuple):
+    habit: Habit
+    completions: int
+    # Shares of periods completed since creation and in the recent window, None while there are no periods to count
+    rate: float
+    consistency: float
+    # Change of consistency against the window before, None if there's nothing to compare with
+    trend: float
+    # Weekday most completions were made on, Monday is 0, None without completions
+    best_weekday: int
+    streaks: Streaks
+
+async def load_completions(user_id: int) -> list[tuple[Habit, Sequence[int]]]:
+    "Pulls user's habits with sorted ordinals of their completion dates, NumPy arrays when it's installed"
+    habits_stmt = select(Habit).where(Habit.user_id == user_id).order_by(Habit.starred.desc(), Habit.id)
+    # Postgres subtracts dates in days, so ordinals come ready, without building date objects.
+    # date(1, 1, 1) would be sent as -infinity, the epoch is subtracted instead
+    day = HabitCompletion.created_date - literal(date(1970, 1, 1), Date) + EPOCH
+    stmt = (
+        select(HabitCompletion.habit_id, day)
+        .join(Habit, Habit.id == HabitCompletion.habit_id)
+        .where(Habit.user_id == user_id)
+        .order_by(HabitCompletion.habit_id, HabitCompletion.created_date)
+    )
+    async with scoped_session(Habit.session) as ses:
+        habits = (await ses.scalars(habits_stmt)).all()
+        rows = (await ses.execute(stmt)).all()
+
+    if numpy is None:
+        days = {}
+        for habit_id, day in rows:
+            days.setdefault(habit_id, []).append(day)
+        return [(habit, days.get(habit.id, [])) for habit in habits]
+
+    table = numpy.fromiter(chain.from_iterable(rows), dtype = numpy.int64, count = 2 * len(rows)).reshape(-1, 2)
+    ids, days = table[:, 0], numpy.ascontiguousarray(table[:, 1])
+    starts = numpy.searchsorted(ids, [habit.id for habit in habits], side = "left")
+    ends = numpy.searchsorted(ids, [habit.id for habit in habits], side = "right")
+    return [(habit, days[start:end]) for habit, start, end in zip(habits, starts, ends)]
+
+def period_keys(period: str, days: Sequence[int]) -> Sequence[int]:
+    "Sorted unique indexes of periods the days fall in, same as periods.period_key gives"
+    if numpy is None:
+        return sorted({period_key(period, date.fromordinal(day)) for day in days})
+    days = numpy.asarray(days, dtype = numpy.int64)
+    if period == 'Daily':
+        keys = days
+    elif period == 'Weekly':
+        keys = (days - 1) // 7
+    else:
+        months = (days - EPOCH).astype("datetime64[D]").astype("datetime64[M]").astype(numpy.int64)
+        keys = months + 1970 * 12
+    return numpy.unique(keys)
+
+def count_between(keys: Sequence[int], start: int, end: int) -> int:
+    "Number of keys from start to end inclusive, keys are sorted"
+    return bisect_right(keys, end) - bisect_left(keys, start)
+
+def share(keys: Sequence[int], start: int, end: int, now: int) -> float:
+    "Share of periods from start to end that are completed, the current period counts only once it is"
+    if start > end:
+        return None
+    total = end - start + 1
+    if end == now and not count_between(keys, now, now):
+        total -= 1
+    return count_between(keys, start, end) / total if total else None
+
+def runs(keys: Sequence[int]) -> tuple[int, int]:
+    "Lengths of the longest and the last run of consecutive keys"
+    if numpy is None:
+        longest = run = 0
+        previous = None
+        for key in keys:
+            run = run + 1 if previous is not None and key == previous + 1 else 1
+            longest = max(longest, run)
+            previous = key
+        return longest, run
+    # Indexes of the last key of every run
+    ends = numpy.flatnonzero(numpy.diff(keys) != 1)
+    lengths = numpy.diff(numpy.concatenate(([-1], ends, [len(keys) - 1])))
+    return int(lengths.max()), int(lengths[-1])
+
+def find_streaks(keys: Sequence[int], first: int, now: int) -> Streaks:
+    "Same streaks compute_streaks gives, from sorted period indexes"
+    keys = keys[bisect_left(keys, first):bisect_right(keys, now)]
+    if len(keys) == 0:
+        return Streaks(0, 0)
+    longest, last = runs(keys)
+    # Incomplete current period doesn't break the streak ending right before it
+    return Streaks(last if keys[-1] >= now - 1 else 0, longest)
+
+def best_weekday(days: Sequence[int]) -> int:
+    if len(days) == 0:
+        return None
+    # date(1, 1, 1) is a Monday
+    if numpy is None:
+        counts = Counter((day - 1) % 7 for day in days)
+        return max(range(7), key = lambda weekday: counts[weekday])
+    return int(numpy.bincount((numpy.asarray(days) - 1) % 7, minlength = 7).argmax())
+
+def habit_stats(habit: Habit, days: Sequence[int], today: date = None) -> HabitStats:
+    "Computes stats of a habit from sorted ordinals of its completion dates"
+    today = today or local_today()
+    weekday = best_weekday(days)
+    period, created_date = habit.period, habit.created_date
+    if period not in PERIODS or created_date is None or today < created_date:
+        return HabitStats(habit, len(days), None, None, None, weekday, Streaks(0, 0))
+
+    keys = period_keys(period, days)
+    now = period_key(period, today)
+    first = min(first_full_period(period, created_date), now)
+    window_start = period_key(period, today - timedelta(days = WINDOW_DAYS - 1))
+    previous_end = period_key(period, today - timedelta(days = WINDOW_DAYS))
+    previous_start = period_key(period, today - timedelta(days = 2 * WINDOW_DAYS - 1))
+
+    consistency = share(keys, max(first, window_start), now, now)
+    previous = share(keys, max(first, previous_start), previous_end, now)
+    trend = consistency - previous if consistency is not None and previous is not None else None
+    return HabitStats(habit, len(days), share(keys, first, now, now), consistency, trend, weekday, find_streaks(keys, first, now))
+
+def analyze(habits: list[tuple[Habit, Sequence[int]]], today: date = None) -> list[HabitStats]:
+    today = today or local_today()
+    return [habit_stats(habit, days, today) for habit, days in habits]
+
+async def get_habits_stats(user_id: int, today: date = None) -> list[HabitStats]:
+    "Loads all user's completions once and computes stats of every habit"
+    return analyze(await load_completions(user_id), today)
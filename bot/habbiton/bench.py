@@ -0,0 +1,301 @@
+"""
+End-to-end benchmark. Seeds the db with synthetic users, habits and years of completions, replays
+realistic update streams through the dispatcher with a bot made like the real one, outbound scheduler
+included, whose fake session sends nothing to Telegram. Reports latency percentiles, db queries and
+Bot API calls per update and throughput.
+Results are saved as JSON, so runs on different commits can be compared.
+Benchmark users get ids from a dedicated range, their previous data is replaced on every run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import subprocess
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from itertools import count, cycle, islice
+from pathlib import Path
+from time import perf_counter
+from typing import Any, AsyncGenerator
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update, Message
+from sqlalchemy import event, select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from habbiton import TOKEN, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, engine, cache
+from habbiton.models.user import User
+from habbiton.models.habit import Habit, HabitCompletion
+from habbiton.models.reminder import ReminderLog
+from habbiton.periods import period_key, period_start
+from habbiton.utils import FIXTURE_HABITS
+from habbiton.routes import routes
+from habbiton.main import dp, create_bot
+from habbiton.outbound import OutboundScheduler
+
+FIRST_USER = 1_000_000_000
+COPY_CHUNK = 10000
+PERCENTILES = (50, 95, 99)
+
+@dataclass
+class Sample:
+    "Counters of the update being replayed"
+    queries: int = 0
+    api_calls: int = 0
+
+current = ContextVar("bench_sample", default = None)
+
+class FakeSession(BaseSession):
+    "Bot session answering every request locally, after an optional delay imitating Bot API latency"
+    def __init__(self, latency: float = 0):
+        super().__init__()
+        self.latency = latency
+        self.message_ids = count(1)
+        # Registered before the bot's middlewares, so calls are counted in the update's context,
+        # not in the outbound scheduler's task which makes them later
+        self.middleware(count_api_calls)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int = None) -> Any:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.__returning__ is Message:
+            return Message.model_validate({
+                "message_id": next(self.message_ids),
+                "date": datetime.now(),
+                "chat": {"id": method.chat_id, "type": "private"},
+                "text": getattr(method, "text", None)
+            }, context = {"bot": bot})
+        # Edits and deletions, the handlers don't look at their results
+        return True
+
+    async def stream_content(self, *args, **kwargs) -> AsyncGenerator[bytes, None]:
+        raise RuntimeError("File downloads aren't part of the benchmark, FakeSession doesn't serve them")
+        # Unreachable, makes it an async generator like BaseSession.stream_content
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+async def count_api_calls(make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+    sample = current.get()
+    if sample is not None:
+        sample.api_calls += 1
+    return await make_request(bot, method)
+
+def count_queries(conn, cursor, statement, parameters, context, executemany) -> None:
+    sample = current.get()
+    if sample is not None:
+        sample.queries += 1
+
+async def seed(users: int, habits: int, years: float, first_user: int = FIRST_USER, bind: AsyncEngine = engine, rng: random.Random = None) -> dict[int, list[int]]:
+    """
+    Replaces benchmark users' data with users having habits of the test fixture's shapes, created years ago
+    and completed in most of past periods, returns habit ids by user
+    """
+    rng = rng or random.Random(0)
+    today = date.today()
+    created_date = today - timedelta(days = round(365 * years))
+    user_ids = list(range(first_user, first_user + users))
+    users_table, habits_table, completions_table = User.__table__, Habit.__table__, HabitCompletion.__table__
+    bench_habits = select(habits_table.c.id).where(habits_table.c.user_id.in_(user_ids))
+
+    async with bind.begin() as conn:
+        await conn.execute(delete(completions_table).where(completions_table.c.habit_id.in_(bench_habits)))
+        await conn.execute(delete(habits_table).where(habits_table.c.user_id.in_(user_ids)))
+        await conn.execute(delete(ReminderLog.__table__).where(ReminderLog.__table__.c.user_id.in_(user_ids)))
+        await conn.execute(delete(users_table).where(users_table.c.id.in_(user_ids)))
+        await conn.execute(insert(users_table), [{"id": id, "username": f"bench{id}", "current_level": "main"} for id in user_ids])
+
+        rows = [
+            {"user_id": user_id, "name": name, "period": period, "starred": starred, "created_date": created_date}
+            for user_id in user_ids for name, period, starred in islice(cycle(FIXTURE_HABITS), habits)
+        ]
+        stmt = insert(habits_table).returning(habits_table.c.id, habits_table.c.user_id, habits_table.c.period, sort_by_parameter_order = True)
+        created = (await conn.execute(stmt, rows)).all()
+
+        raw = (await conn.get_raw_connection()).driver_connection
+        records = []
+        for habit_id, user_id, period in created:
+            rate = rng.uniform(0.5, 0.95)
+            # Current periods are left incomplete, so replayed completions go through
+            for key in range(period_key(period, created_date), period_key(period, today)):
+                if rng.random() < rate:
+                    records.append((habit_id, max(period_start(period, key), created_date), key))
+            if len(records) >= COPY_CHUNK:
+                await raw.copy_records_to_table(completions_table.name, records = records, columns = ["habit_id", "created_date", "period_key"])
+                records = []
+        if records:
+            await raw.copy_records_to_table(completions_table.name, records = records, columns = ["habit_id", "created_date", "period_key"])
+        await Habit.rebuild_counters(conn, user_ids = user_ids)
+    # Users and their habits were replaced behind the models' backs
+    await cache.backend.invalidate(*map(cache.user_key, user_ids), *map(cache.habits_key, user_ids))
+
+    habit_ids = {user_id: [] for user_id in user_ids}
+    for habit_id, user_id, _ in created:
+        habit_ids[user_id].append(habit_id)
+    return habit_ids
+
+def scenario(user_id: int, habit_ids: list[int], rounds: int):
+    "Yields (kind, update data) of a user opening the bot, browsing and completing habits and checking stats"
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    message_ids = count(1)
+
+    def message(text):
+        return {"message": {"message_id": next(message_ids), "date": datetime.now(), "chat": chat, "from": user, "text": text}}
+
+    def callback(data):
+        shown = {"message_id": next(message_ids), "date": datetime.now(), "chat": chat, "text": "Total"}
+        return {"callback_query": {"id": str(next(message_ids)), "from": user, "chat_instance": str(user_id), "data": data, "message": shown}}
+
+    yield "start", message("/start")
+    for round in range(rounds):
+        habit_id = habit_ids[round % len(habit_ids)]
+        yield "my_habits", message("My habits")
+        yield "info", callback(routes.pack("info", habit_id))
+        yield "complete", callback(routes.pack("complete", habit_id))
+        yield "filter", callback(routes.pack("show_habits", True, "Daily"))
+        yield "back", message("Back")
+        yield "my_stats", message("My stats")
+        yield "back", message("Back")
+
+def percentile(values: list[float], p: float) -> float:
+    "Nearest-rank percentile of sorted values"
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+def summarize(samples: list[tuple[float, Sample]]) -> dict:
+    latencies = sorted(seconds for seconds, _ in samples)
+    summary = {"count": len(samples)}
+    for p in PERCENTILES:
+        summary[f"p{p}_ms"] = round(percentile(latencies, p) * 1000, 3)
+    summary["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 3)
+    summary["queries_per_update"] = round(sum(sample.queries for _, sample in samples) / len(samples), 2)
+    summary["api_calls_per_update"] = round(sum(sample.api_calls for _, sample in samples) / len(samples), 2)
+    return summary
+
+async def replay(bot: Bot, habit_ids: dict[int, list[int]], rounds: int, concurrency: int) -> tuple[dict[str, list], float]:
+    "Feeds every user's stream, users are replayed concurrently, updates of one user one after another"
+    update_ids = count(1)
+    samples: dict[str, list] = {}
+    users = asyncio.Queue()
+    for user_id in habit_ids:
+        users.put_nowait(user_id)
+
+    async def replay_user(user_id):
+        for kind, data in scenario(user_id, habit_ids[user_id], rounds):
+            update = Update.model_validate({"update_id": next(update_ids), **data}, context = {"bot": bot})
+            sample = Sample()
+            token = current.set(sample)
+            start = perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            finally:
+                current.reset(token)
+            samples.setdefault(kind, []).append((perf_counter() - start, sample))
+
+    async def run():
+        while not users.empty():
+            await replay_user(users.get_nowait())
+
+    start = perf_counter()
+    await asyncio.gather(*(run() for _ in range(concurrency)))
+    return samples, perf_counter() - start
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_benchmark(
+    users: int = 100,
+    habits: int = 5,
+    years: float = 2,
+    rounds: int = 5,
+    concurrency: int = 10,
+    latency: float = 0,
+    global_rate: float = OUTBOUND_GLOBAL_RATE,
+    chat_rate: float = OUTBOUND_CHAT_RATE,
+    first_user: int = FIRST_USER,
+    bind: AsyncEngine = engine,
+    serve_metrics: bool = False
+) -> dict:
+    """
+    Seeds data, replays updates and returns results, db schema and bot's levels should already exist.
+    Bot API requests wait in the outbound scheduler limited to the given rates, like in production.
+    """
+    start = perf_counter()
+    habit_ids = await seed(users, habits, years, first_user, bind)
+    seed_seconds = perf_counter() - start
+
+    scheduler = OutboundScheduler(global_rate = global_rate, chat_rate = chat_rate, chat_burst = OUTBOUND_CHAT_BURST)
+    bot = create_bot(TOKEN or "42:BENCHMARK", FakeSession(latency), scheduler)
+    event.listen(bind.sync_engine, "before_cursor_execute", count_queries)
+    # Db is already prepared, startup only loads caches, like in a worker process
+    await dp.emit_startup(bot = bot, worker = 0, serve_metrics = serve_metrics)
+    try:
+        samples, seconds = await replay(bot, habit_ids, rounds, concurrency)
+    finally:
+        await dp.emit_shutdown(bot = bot, worker = 0)
+        event.remove(bind.sync_engine, "before_cursor_execute", count_queries)
+
+    everything = [sample for kind_samples in samples.values() for sample in kind_samples]
+    return {
+        "commit": current_commit(),
+        "created": datetime.now().isoformat(timespec = "seconds"),
+        "params": {
+            "users": users, "habits": habits, "years": years, "rounds": rounds, "concurrency": concurrency,
+            "latency": latency, "global_rate": global_rate, "chat_rate": chat_rate
+        },
+        "seed_seconds": round(seed_seconds, 3),
+        "seconds": round(seconds, 3),
+        "throughput": round(len(everything) / seconds, 2),
+        "total": summarize(everything),
+        "kinds": {kind: summarize(kind_samples) for kind, kind_samples in samples.items()},
+    }
+
+def compare(results: dict, baseline: dict) -> str:
+    "Formats p95 latency and queries per update of two runs side by side"
+    lines = [f"{baseline['commit']} -> {results['commit']}", f"{'':12} {'p95 ms':^22} {'queries per update':^18}"]
+    for kind, summary in {"total": results["total"], **results["kinds"]}.items():
+        old = baseline["total"] if kind == "total" else baseline["kinds"].get(kind)
+        if old is None:
+            continue
+        lines.append(f"{kind:12} {old['p95_ms']:>9} -> {summary['p95_ms']:<9} {old['queries_per_update']:>7} -> {summary['queries_per_update']:<7}")
+    lines.append(f"{'throughput':12} {baseline['throughput']} -> {results['throughput']} updates/s")
+    return "\n".join(lines)
+
+def main():
+    "Console entry point, runs the benchmark against the configured db"
+    parser = argparse.ArgumentParser(description = main.__doc__)
+    parser.add_argument("--users", type = int, default = 100)
+    parser.add_argument("--habits", type = int, default = 5, help = "habits per user")
+    parser.add_argument("--years", type = float, default = 2, help = "years of completions history")
+    parser.add_argument("--rounds", type = int, default = 5, help = "times every user goes through the scenario")
+    parser.add_argument("--concurrency", type = int, default = 10, help = "users replayed at once")
+    parser.add_argument("--latency", type = float, default = 0, help = "seconds every Bot API call takes")
+    parser.add_argument("--global-rate", type = float, default = OUTBOUND_GLOBAL_RATE, help = "Bot API requests per second for all chats")
+    parser.add_argument("--chat-rate", type = float, default = OUTBOUND_CHAT_RATE, help = "Bot API requests per second to one chat")
+    parser.add_argument("--metrics", action = "store_true", help = "serve metrics on METRICS_PORT while running")
+    parser.add_argument("--output", type = Path, default = Path("bench.json"))
+    parser.add_argument("--compare", type = Path, help = "results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    from habbiton.utils import fill_new_db
+    async def run():
+        await fill_new_db()
+        return await run_benchmark(
+            args.users, args.habits, args.years, args.rounds, args.concurrency, args.latency,
+            args.global_rate, args.chat_rate, serve_metrics = args.metrics
+        )
+    results = asyncio.run(run())
+
+    args.output.write_text(json.dumps(results, indent = 2))
+    print(json.dumps(results["total"]))
+    if args.compare:
+        print(compare(results, json.loads(args.compare.read_text())))
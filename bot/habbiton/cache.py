@@ -0,0 +1,228 @@
+"""
+Cache shared by bot instances. Read paths of users, levels and habits look rows up here before the db,
+writes invalidate changed keys and publish them, so every instance drops its in-process copies too.
+The in-memory backend serves a single instance, the Redis one (CACHE_URL=redis://..., needs redis
+package installed) is shared by all instances pointed at the same server.
+Values are JSON strings, rows are converted with dump_row and load_row.
+"""
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import date
+from time import monotonic
+from typing import Callable
+from uuid import uuid4
+from sqlalchemy import Date
+
+from habbiton import CACHE_URL, CACHE_SIZE, CACHE_TTL
+from habbiton.uow import after_commit
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+#Redis channel invalidated keys are published to, and prefix of cache keys
+CHANNEL = "habbiton:invalidate"
+PREFIX = "habbiton:"
+LEVELS_KEY = "levels"
+
+def user_key(id: int) -> str:
+    return f"user:{id}"
+
+def habit_key(id: int) -> str:
+    return f"habit:{id}"
+
+def habits_key(user_id: int) -> str:
+    "Stands for all habits of the user, nothing is stored under it, it's only published"
+    return f"habits:{user_id}"
+
+subscribers: list[Callable[[str], None]] = []
+
+def subscribe(callback: Callable[[str], None]) -> Callable[[str], None]:
+    "Registers a function called with every invalidated key, by this instance or any other"
+    subscribers.append(callback)
+    return callback
+
+def notify(keys) -> None:
+    for key in keys:
+        for callback in subscribers:
+            try:
+                callback(key)
+            except Exception:
+                logger.exception(f"Failed to invalidate {key}")
+
+def dump_row(obj) -> dict:
+    "Column values of a model instance, ready for json"
+    return {column.key: getattr(obj, column.key) for column in obj.__table__.columns}
+
+def load_row(cls, values: dict):
+    "Detached model instance from values written by dump_row and read back from json"
+    for column in cls.__table__.columns:
+        value = values.get(column.key)
+        if isinstance(value, str) and isinstance(column.type, Date):
+            values[column.key] = date.fromisoformat(value)
+    return cls(**values)
+
+def encode(value) -> str:
+    return json.dumps(value, default = date.isoformat)
+
+class CacheBackend(ABC):
+    "Where cached values live and how invalidations reach other instances"
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> str:
+        "Value stored under the key, None if there's none or it expired"
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float = None) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> None:
+        ...
+
+    @abstractmethod
+    async def publish(self, *keys: str) -> None:
+        "Tells subscribers of every instance, this one included, about the keys"
+
+    async def invalidate(self, *keys: str) -> None:
+        "Deletes keys and tells subscribers of every instance about them"
+        await self.delete(*keys)
+        await self.publish(*keys)
+
+class MemoryCache(CacheBackend):
+    "In-process LRU with expiring entries, for a single bot instance"
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.values: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def get(self, key: str) -> str:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < monotonic():
+            del self.values[key]
+            return None
+        self.values.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float = None) -> None:
+        self.values[key] = (monotonic() + (ttl or self.ttl), value)
+        self.values.move_to_end(key)
+        while len(self.values) > self.size:
+            self.values.popitem(last = False)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.values.pop(key, None)
+
+    async def publish(self, *keys: str) -> None:
+        notify(keys)
+
+class RedisCache(CacheBackend):
+    """
+    Cache in a Redis compatible server, invalidations go through its pub/sub to all instances.
+    Failing server only makes reads miss, the bot keeps working from db.
+    """
+    def __init__(self, url: str = None, ttl: float = CACHE_TTL, client = None):
+        if redis is None:
+            raise RuntimeError("Redis cache needs redis package installed")
+        self.client = client or redis.from_url(url)
+        self.ttl = ttl
+        # Own messages come back from the channel, subscribers were already notified of them
+        self.origin = uuid4().hex
+        self.pubsub = None
+        self.listener = None
+
+    async def start(self) -> None:
+        if self.listener is None:
+            self.pubsub = self.client.pubsub()
+            await self.pubsub.subscribe(CHANNEL)
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+            await self.pubsub.aclose()
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data["origin"] != self.origin:
+                        notify(data["keys"])
+            except redis.RedisError as e:
+                logger.error(f"Cache invalidations are not received: {e}")
+                await asyncio.sleep(1)
+
+    async def get(self, key: str) -> str:
+        try:
+            value = await self.client.get(PREFIX + key)
+        except redis.RedisError as e:
+            logger.warning(f"Cache read failed: {e}")
+            return None
+        return value.decode() if value is not None else None
+
+    async def set(self, key: str, value: str, ttl: float = None) -> None:
+        try:
+            await self.client.set(PREFIX + key, value, px = round((ttl or self.ttl) * 1000))
+        except redis.RedisError as e:
+            logger.warning(f"Cache write failed: {e}")
+
+    async def delete(self, *keys: str) -> None:
+        try:
+            await self.client.delete(*(PREFIX + key for key in keys))
+        except redis.RedisError as e:
+            logger.warning(f"Cache delete failed: {e}")
+
+    async def publish(self, *keys: str) -> None:
+        notify(keys)
+        try:
+            await self.client.publish(CHANNEL, json.dumps({"origin": self.origin, "keys": keys}))
+        except redis.RedisError as e:
+            logger.warning(f"Cache invalidation publish failed: {e}")
+
+def create_backend(url: str = CACHE_URL) -> CacheBackend:
+    if url:
+        return RedisCache(url)
+    return MemoryCache()
+
+backend = create_backend()
+
+def set_backend(cache: CacheBackend) -> None:
+    global backend
+    backend = cache
+
+async def get_row(cls, key: str):
+    "Cached model instance, None if it's not there"
+    value = await backend.get(key)
+    return load_row(cls, json.loads(value)) if value is not None else None
+
+async def set_row(key: str, obj) -> None:
+    await backend.set(key, encode(dump_row(obj)))
+
+async def changed(ses, *keys: str) -> None:
+    "Invalidates keys right away and, if changed in a session, once more after its commit"
+    await backend.invalidate(*keys)
+    if ses is not None:
+        after_commit(ses, lambda: backend.invalidate(*keys))
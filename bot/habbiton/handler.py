@@ -1,13 +1,30 @@
 from habbiton.models.state import Level
-from habbiton.models.habit import Habit
+from habbiton.models.habit import Habit, Cursor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from habbiton import utils
+import asyncio
+from habbiton import utils, outbound, uow
+from habbiton.periods import PERIODS, valid_timezone
+from habbiton.routes import routes, INT, FLAG, ChoiceCodec, TupleCodec
+from habbiton import render
+from datetime import date
+from habbiton.stats import get_user_stats
+from habbiton.analytics import HabitStats
+from habbiton import HABITS_PAGE_SIZE
+from calendar import day_name
+
+UNITS = {'Daily': 'd', 'Weekly': 'w', 'Monthly': 'm'}
+PERIOD_NAMES = {'Daily': 'days', 'Weekly': 'weeks', 'Monthly': 'months'}
 
 class Handler:
     "Main handler class, for bot event processing"
     def __init__(self, user, message):
         self.user = user
         self.message = message
+
+    @property
+    def today(self) -> date:
+        "Current date in the user's timezone"
+        return self.user.calendar.today()
     
     async def handle(self) -> None:
         """
@@ -15,101 +32,143 @@ class Handler:
         This method processes all messages except the /start command. It checks if the message
         matches any buttons in the current level and handles callbacks appropriately.
         """
-        self.level = await Level.from_name(self.user.current_level)
+        graph = await Level.get_graph()
+        self.level = graph.level(self.user.current_level)
         
-        button = await self.level.check_button(self.message.text)
+        button = graph.check_button(self.level.name, self.message.text)
         if button:
             await self.move_user(button.target_level_name)
             if button.callback:
-                await getattr(self, button.callback)()
+                await routes.call(self, button.callback)
             return
         
         if self.level.callback:
-            await getattr(self, self.level.callback)()
+            await routes.call(self, self.level.callback)
 
     async def handle_start(self) -> None:
         await self.move_user('start')
-        await self.move_user('main')
+        await self.move_user('main', flush=True)
 
-    async def move_user(self, level_name: str) -> None:
-        await self.user.update(current_level=level_name)
+    async def move_user(self, level_name: str, flush: bool = False) -> None:
+        await self.user.update(current_level=level_name, flush=flush)
 
-        buttons = await Level(name = level_name).get_buttons()
-        for message in await Level(name = level_name).get_messages():
-            await self.message.answer(message.text, reply_markup=buttons)
+        level = (await Level.get_graph()).level(level_name)
+        # Committed first, so the messages are queued at once and can be merged
+        await uow.release()
+        # Queued together, so the outbound scheduler can send them as one message, in order
+        with outbound.mergeable():
+            # Methods aren't coroutines, gather needs them wrapped into futures
+            await asyncio.gather(*[
+                asyncio.ensure_future(self.message.answer(text, reply_markup=level.keyboard))
+                for text in level.messages
+            ])
 
-    async def show_habits(self, update = 'n', filter = None) -> None:
-        "Callback to form a list of all habits, supports filtering, shows which habits are checked"
-        if filter:
-            habits = await Habit.get_user_habits(self.user.id, filter)
-        else:
-            habits = await Habit.get_user_habits(self.user.id)
+    @routes.route(1, FLAG, ChoiceCodec(*PERIODS), TupleCodec(FLAG, INT, FLAG))
+    async def show_habits(self, update: bool = False, filter: str = None, page: tuple = None) -> None:
+        "Callback to form a list of all habits, supports filtering and paging, shows which habits are checked"
+        page = page and Cursor(*page)
+        text, reply_markup = await render.cache.get(self.user.id, ("habits", filter, page, self.today), lambda: self.render_habits(filter, page))
+        if update:
+            await self.edit(text, reply_markup)
+        else: 
+            msg = await self.message.answer(text, reply_markup = reply_markup)
+            await self.user.update(latest_msg_id=msg.message_id)
+
+    async def render_habits(self, filter: str = None, page: Cursor = None) -> tuple[str, InlineKeyboardMarkup]:
+        habits, previous, next = await Habit.get_user_habits_page(self.user.id, filter, page, today = self.today)
         if len(habits) == 0:    
             text = "Seems that you don't have any habits yet"
             reply_markup=InlineKeyboardMarkup(
-                inline_keyboard = [[InlineKeyboardButton(text = "Create text fixture", callback_data = "fixture")]])
+                inline_keyboard = [[InlineKeyboardButton(text = "Create text fixture", callback_data = routes.pack("fixture"))]])
         else:
             buttons = [
                 [
                     InlineKeyboardButton(
-                        text = ("⭐ " if habit.starred else "") +  habit.name + (" ✔️" if await habit.check_completion() else " ❌"), callback_data = f"info|{habit.id}"
+                        text = ("⭐ " if habit.starred else "") +  habit.name + (" ✔️" if completed else " ❌"), callback_data = routes.pack("info", habit.id)
                         )
-                ] for habit in habits ]
+                ] for habit, completed in habits ]
             
             filter_menu = [   
                 InlineKeyboardButton(
-                    text = "All", callback_data = f"show_habits|y"
+                    text = "All", callback_data = routes.pack("show_habits", True)
                     ),
                 InlineKeyboardButton(
-                    text = "Daily", callback_data = f"show_habits|y|Daily"
+                    text = "Daily", callback_data = routes.pack("show_habits", True, "Daily")
                     ),
                 InlineKeyboardButton(
-                    text = "Weekly", callback_data = f"show_habits|y|Weekly"
+                    text = "Weekly", callback_data = routes.pack("show_habits", True, "Weekly")
                     ),
                 InlineKeyboardButton(
-                    text = "Monthly", callback_data = f"show_habits|y|Monthly"
+                    text = "Monthly", callback_data = routes.pack("show_habits", True, "Monthly")
                     )
             ]
 
             buttons.insert(0, filter_menu)
-            text = f"Total: {len(habits)}"
+            pages = [
+                InlineKeyboardButton(text = text, callback_data = routes.pack("show_habits", True, filter, cursor))
+                for text, cursor in (("◀️", previous), ("▶️", next)) if cursor
+            ]
+            if pages:
+                buttons.append(pages)
+                total = await Habit.count_user_habits(self.user.id, filter)
+            else:
+                total = len(habits)
+            text = f"Total: {total}"
             reply_markup=InlineKeyboardMarkup(
                 inline_keyboard = buttons
             )
-        if update == 'y':
-            await self.message.message.edit_text(text, reply_markup = reply_markup)
-        else: 
-            msg = await self.message.answer(text, reply_markup = reply_markup)
-            await self.user.update(latest_msg_id=msg.message_id)
+        return text, reply_markup
+
+    async def edit(self, text: str, reply_markup: InlineKeyboardMarkup) -> None:
+        "Edits message the inline button was pressed on, unless it already shows the same"
+        message = self.message.message
+        shown = getattr(message, "reply_markup", None)
+        # Markups of received messages keep the bot in their context, so fields are compared
+        if getattr(message, "text", None) == text and shown is not None and shown.model_dump() == reply_markup.model_dump():
+            # Telegram would reject the edit as not modified
+            await self.message.answer()
+            return
+        await message.edit_text(text, reply_markup = reply_markup)
 
+    @routes.route()
     async def purge_msg(self) -> None:
         "Deletes message with inline buttons"
         if self.user.latest_msg_id:
             await self.message.bot.delete_message(self.user.id, self.user.latest_msg_id)
             await self.user.update(latest_msg_id=None)
    
+    @routes.route()
     async def get_habit_name(self) -> None:
-        await Habit.new(self.message.text, self.user.id)
+        await Habit.new(self.message.text, self.user.id, self.today)
         await self.move_user('new_habit_period')
     
+    @routes.route()
     async def delete_unfinished_habit(self) -> None:
         await Habit.delete_unfinished(self.user.id)        
     
+    @routes.route()
     async def set_habit_period(self) -> None:
         await Habit.set_period(self.message.text, self.user.id)
         await self.move_user('main')
     
-    async def info(self, id: str) -> None:
+    @routes.route(2, INT)
+    async def info(self, id: int) -> None:
         "Callback for getting info about particular habit, triggered from inline buttons"
+        text, reply_markup = await render.cache.get(self.user.id, ("info", id, self.today), lambda: self.render_info(id))
+        await self.edit(text, reply_markup)
+
+    async def render_info(self, id: int) -> tuple[str, InlineKeyboardMarkup]:
         habit = await Habit.get_user_habit(self.user.id, id)
         info_msg = f"Name: {habit.name}\n\n"
         info_msg += f"Start date: {habit.created_date}\n"
         info_msg += f"Period: {habit.period}\n"
-        info_msg += f"Current streak: {await habit.calculate_streak()}\n"
-        info_msg += f"Max streak: {await habit.calculate_longest_streak()}"
+        today = self.today
+        streaks = habit.streaks(today)
+        info_msg += f"Current streak: {streaks.current}\n"
+        info_msg += f"Max streak: {streaks.longest}"
         buttons = []
-        if not await habit.check_completion():
-            buttons.append([InlineKeyboardButton(text = "Complete", callback_data = f"complete|{habit.id}")])
+        if not habit.completed_in_current_period(today):
+            buttons.append([InlineKeyboardButton(text = "Complete", callback_data = routes.pack("complete", habit.id))])
         
         if habit.starred:
             msg = "Unstar"
@@ -117,69 +176,98 @@ class Handler:
             msg = "Star"
         buttons.append(
             [
-                InlineKeyboardButton(text = msg, callback_data = f"star|{habit.id}"), 
-                InlineKeyboardButton(text = "Delete", callback_data = f"delete|{habit.id}")
+                InlineKeyboardButton(text = msg, callback_data = routes.pack("star", habit.id)), 
+                InlineKeyboardButton(text = "Delete", callback_data = routes.pack("delete", habit.id))
             ]
         )
-        buttons.append([InlineKeyboardButton(text = "Back", callback_data = "show_habits|y")])
+        buttons.append([InlineKeyboardButton(text = "Back", callback_data = routes.pack("show_habits", True))])
 
         reply_markup = InlineKeyboardMarkup(
             inline_keyboard = buttons
         )
-        await self.message.message.edit_text(info_msg, reply_markup = reply_markup)
+        return info_msg, reply_markup
 
-    async def complete(self, id: str) -> None:
+    @routes.route(3, INT)
+    async def complete(self, id: int) -> None:
         habit = await Habit.get_user_habit(self.user.id, id)
-        await habit.complete()
-        await self.show_habits('y')
+        await habit.complete(self.today)
+        await self.show_habits(update=True)
     
-    async def star(self, id: str) -> None:
+    @routes.route(4, INT)
+    async def star(self, id: int) -> None:
         habit = await Habit.get_user_habit(self.user.id, id)
         await habit.star()
         await self.info(id)
     
-    async def delete(self, id: str) -> None:
+    @routes.route(5, INT)
+    async def delete(self, id: int) -> None:
         habit = await Habit.get_user_habit(self.user.id, id)
         await habit.delete()
-        await self.show_habits('y')
+        await self.show_habits(update=True)
     
+    @routes.route()
     async def show_stats(self) -> None:
-        "Callback for stats menu, sends global info about user's habits"
-        habits = await Habit.get_user_habits(self.user.id)
-        if len(habits) == 0:
-            await self.message.answer("You don't have any habits yet")
-            return
-        text = f"Total habits num: {len(habits)}\n\n"
-
-        d_habits = [habit for habit in habits if habit.period == 'Daily']
-        max, habit = await self.calculate_longest_streak(d_habits)
-        if habit:
-            text += f"Longest streak for daily: {habit.name}, {max} d\n"
-
-        w_habits = [habit for habit in habits if habit.period == 'Weekly']
-        max, habit = await self.calculate_longest_streak(w_habits)
-        if habit:
-            text += f"Longest streak for weekly: {habit.name}, {max} w\n"
-
-        m_habits = [habit for habit in habits if habit.period == 'Monthly']
-        max, habit = await self.calculate_longest_streak(m_habits)
-        if habit:
-            text += f"Longest streak for monthly: {habit.name}, {max} m\n"
-        
+        "Callback for stats menu, sends global info about user's habits and stats of every habit"
+        text = await render.cache.get(self.user.id, ("stats", self.today), self.render_stats)
         await self.message.answer(text)
 
-    async def fixture(self) -> None:
-        await utils.create_test_fixture(self.user.id)
-        await self.show_habits('y')
+    async def render_stats(self) -> str:
+        stats = await get_user_stats(self.user.id, self.today)
+        if stats.total == 0:
+            return "You don't have any habits yet"
+        text = f"Total habits num: {stats.total}\n\n"
+
+        for period, leader in stats.leaders.items():
+            text += f"Longest streak for {period.lower()}: {leader.habit.name}, {leader.streak} {UNITS[period]}\n"
+
+        habits = [habit_stats for habit_stats in stats.habits if habit_stats.habit.period in PERIODS]
+        for habit_stats in habits[:HABITS_PAGE_SIZE]:
+            text += "\n" + self.format_habit_stats(habit_stats)
+        if len(habits) > HABITS_PAGE_SIZE:
+            text += f"\n...and {len(habits) - HABITS_PAGE_SIZE} more"
+        return text
 
     @staticmethod
-    async def calculate_longest_streak(habits: list[Habit]) -> None:
-        "Helper method to find a habit with the longest streak in a list"
-        max = 0
-        max_habit = None
-        for habit in habits:
-            d_max = await habit.calculate_longest_streak()
-            if d_max > max:
-                max = d_max
-                max_habit = habit
-        return max, max_habit
\ No newline at end of file
+    def format_habit_stats(stats: HabitStats) -> str:
+        habit, unit = stats.habit, UNITS[stats.habit.period]
+        text = ("⭐ " if habit.starred else "") + habit.name
+        if stats.rate is not None:
+            text += f": {stats.rate:.0%} of {PERIOD_NAMES[habit.period]}"
+        if stats.consistency is not None:
+            text += f", {stats.consistency:.0%} in last 4 weeks"
+            if stats.trend is not None:
+                text += f" ({stats.trend:+.0%})"
+        text += f"\nStreak {stats.streaks.current} {unit}, longest {stats.streaks.longest} {unit}"
+        if stats.best_weekday is not None:
+            text += f", mostly on {day_name[stats.best_weekday]}"
+        return text + "\n"
+
+    async def set_reminder(self, value: str = None) -> None:
+        "Sets time of daily reminders about incomplete habits, value is HH:MM in UTC or 'off'"
+        if value and value.strip().lower() == 'off':
+            await self.user.update(reminder_minute=None)
+            await self.message.answer("Reminders are off")
+            return
+        try:
+            hours, minutes = (int(part) for part in value.strip().split(":"))
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise ValueError
+        except (AttributeError, ValueError):
+            await self.message.answer("Send time of daily reminders as /remind HH:MM (UTC), or /remind off")
+            return
+        await self.user.update(reminder_minute=hours * 60 + minutes)
+        await self.message.answer(f"You'll be reminded about incomplete habits daily at {hours:02}:{minutes:02} UTC")
+
+    async def set_timezone(self, value: str = None) -> None:
+        "Sets timezone days, weeks and months are counted in, value is an IANA name like Europe/Berlin or 'UTC'"
+        value = value and value.strip()
+        if not value or not valid_timezone(value):
+            await self.message.answer("Send your timezone as /timezone Area/City, e.g. /timezone Europe/Berlin, or /timezone UTC")
+            return
+        await self.user.update(timezone=value)
+        await self.message.answer(f"Periods are counted in {value} time now, today is {self.today}")
+
+    @routes.route(6)
+    async def fixture(self) -> None:
+        await utils.create_test_fixture(self.user.id, self.today)
+        await self.show_habits(update=True)
@@ -0,0 +1,229 @@
+"""
+Bulk export and import of users' habits history. Tables are streamed from a server-side cursor
+chunk by chunk into gzipped CSV or NDJSON files, or Parquet when pyarrow is installed, and loaded
+back with COPY, so memory use doesn't depend on the amount of rows moved.
+Import keeps ids, rows already present in the db are skipped.
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import logging
+from datetime import date
+from pathlib import Path
+from sqlalchemy import Table, Boolean, Date, Integer, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from habbiton import engine, cache
+from habbiton.models.user import User
+from habbiton.models.habit import Habit, HabitCompletion
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+#Tables in the order they're loaded, so foreign keys are satisfied
+TABLES: list[Table] = [User.__table__, Habit.__table__, HabitCompletion.__table__]
+FORMATS = ('csv', 'ndjson', 'parquet')
+SUFFIXES = {'csv': '.csv.gz', 'ndjson': '.ndjson.gz', 'parquet': '.parquet'}
+#How NULLs are written to CSV, same as COPY's default for text format
+CSV_NULL = r"\N"
+CHUNK_SIZE = 10000
+
+def table_path(directory: Path, table: Table, format: str) -> Path:
+    return directory / f"{table.name}{SUFFIXES[format]}"
+
+def arrow_schema(table: Table) -> 'pyarrow.Schema':
+    def arrow_type(column):
+        if isinstance(column.type, Boolean):
+            return pyarrow.bool_()
+        if isinstance(column.type, Date):
+            return pyarrow.date32()
+        if isinstance(column.type, Integer):
+            return pyarrow.int64()
+        return pyarrow.string()
+    return pyarrow.schema([(column.name, arrow_type(column)) for column in table.columns])
+
+class CsvWriter:
+    def __init__(self, path: Path, table: Table):
+        self.file = gzip.open(path, "wt", newline = "", compresslevel = 6)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(table.columns.keys())
+
+    def write(self, rows: list) -> None:
+        self.writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+
+    def close(self) -> None:
+        self.file.close()
+
+class NdjsonWriter:
+    def __init__(self, path: Path, table: Table):
+        self.file = gzip.open(path, "wt", compresslevel = 6)
+        self.columns = table.columns.keys()
+
+    def write(self, rows: list) -> None:
+        for row in rows:
+            self.file.write(json.dumps(dict(zip(self.columns, row)), default = date.isoformat) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+class ParquetWriter:
+    def __init__(self, path: Path, table: Table):
+        self.schema = arrow_schema(table)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression = "zstd")
+
+    def write(self, rows: list) -> None:
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(values, field.type) for values, field in zip(columns, self.schema)], schema = self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+WRITERS = {'csv': CsvWriter, 'ndjson': NdjsonWriter, 'parquet': ParquetWriter}
+
+def export_query(table: Table, user_ids: list[int] = None):
+    stmt = select(table).order_by(*table.primary_key.columns)
+    if user_ids:
+        if table is User.__table__:
+            stmt = stmt.where(table.c.id.in_(user_ids))
+        elif table is Habit.__table__:
+            stmt = stmt.where(table.c.user_id.in_(user_ids))
+        else:
+            habits = Habit.__table__
+            stmt = stmt.where(table.c.habit_id.in_(select(habits.c.id).where(habits.c.user_id.in_(user_ids))))
+    return stmt
+
+async def export_history(directory: Path, user_ids: list[int] = None, format: str = 'csv', chunk_size: int = CHUNK_SIZE, bind: AsyncEngine = engine) -> dict[str, int]:
+    "Writes users, habits and completions of particular users or everyone into the directory, returns row counts by table"
+    if format == 'parquet' and pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow installed")
+    directory = Path(directory)
+    directory.mkdir(parents = True, exist_ok = True)
+    counts = {}
+    async with bind.connect() as conn:
+        for table in TABLES:
+            writer = WRITERS[format](table_path(directory, table, format), table)
+            counts[table.name] = 0
+            try:
+                result = await conn.stream(export_query(table, user_ids).execution_options(yield_per = chunk_size))
+                async for rows in result.partitions():
+                    writer.write(rows)
+                    counts[table.name] += len(rows)
+            finally:
+                writer.close()
+            logger.info(f"Exported {counts[table.name]} rows of {table.name}")
+    return counts
+
+def file_columns(path: Path, table: Table) -> list[str]:
+    "Columns of the table present in the file in their order there, exports of older versions may lack newer columns"
+    if path.suffix == '.parquet':
+        names = pyarrow.parquet.read_schema(path).names
+    else:
+        with gzip.open(path, "rt", newline = "") as file:
+            if path.name.endswith('.csv.gz'):
+                names = next(csv.reader(file), None)
+            else:
+                line = file.readline()
+                names = list(json.loads(line)) if line.strip() else None
+    if names is None:
+        return table.columns.keys()
+    return [name for name in names if name in table.columns]
+
+def decode(table: Table, columns: list[str], row: dict) -> tuple:
+    "Converts values read from NDJSON to what COPY expects for the columns"
+    values = []
+    for name in columns:
+        value = row.get(name)
+        if value is not None and isinstance(table.columns[name].type, Date):
+            value = date.fromisoformat(value)
+        values.append(value)
+    return tuple(values)
+
+def read_records(path: Path, table: Table, columns: list[str], chunk_size: int):
+    "Yields chunks of records from NDJSON or Parquet file"
+    if path.suffix == '.parquet':
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(chunk_size, columns = columns):
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+        return
+    with gzip.open(path, "rt") as file:
+        chunk = []
+        for line in file:
+            chunk.append(decode(table, columns, json.loads(line)))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+async def load_table(conn: AsyncConnection, table: Table, path: Path, chunk_size: int) -> int:
+    "Copies a file into a temporary table and moves rows from there, skipping conflicting ones"
+    staging = f"import_{table.name}"
+    columns = file_columns(path, table)
+    names = ", ".join(columns)
+    # Only columns of the file are staged and moved, missing ones get their defaults or are filled by triggers
+    await conn.execute(text(f"CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS SELECT {names} FROM {table.name} WITH NO DATA"))
+    raw = (await conn.get_raw_connection()).driver_connection
+    if path.name.endswith('.csv.gz'):
+        with gzip.open(path, "rb") as file:
+            await raw.copy_to_table(staging, source = file, columns = columns, format = "csv", header = True, null = CSV_NULL)
+    else:
+        for records in read_records(path, table, columns, chunk_size):
+            await raw.copy_records_to_table(staging, records = records, columns = columns)
+
+    result = await conn.execute(text(f"INSERT INTO {table.name} ({names}) SELECT {names} FROM {staging} ON CONFLICT DO NOTHING"))
+    serial = table.autoincrement_column
+    if serial is not None:
+        # Ids came from the files, the sequence has to continue after them
+        await conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', '{serial.name}'), GREATEST((SELECT max({serial.name}) FROM {table.name}), 1))"))
+    return result.rowcount
+
+async def import_history(directory: Path, chunk_size: int = CHUNK_SIZE, bind: AsyncEngine = engine) -> dict[str, int]:
+    "Loads files written by export_history in one transaction, returns numbers of inserted rows by table"
+    directory = Path(directory)
+    counts = {}
+    async with bind.begin() as conn:
+        for table in TABLES:
+            paths = [table_path(directory, table, format) for format in FORMATS if table_path(directory, table, format).exists()]
+            if not paths:
+                raise FileNotFoundError(f"No export of {table.name} found in {directory}")
+            if paths[0].suffix == '.parquet' and pyarrow is None:
+                raise RuntimeError("Parquet import needs pyarrow installed")
+            counts[table.name] = await load_table(conn, table, paths[0], chunk_size)
+            logger.info(f"Imported {counts[table.name]} rows of {table.name}")
+        # Completions were added bypassing Habit.complete, only habits of users found in the files can be affected
+        stmt = text("SELECT DISTINCT user_id FROM habits WHERE id IN (SELECT id FROM import_habits UNION SELECT habit_id FROM import_habit_completions)")
+        user_ids = (await conn.scalars(stmt)).all()
+        await Habit.rebuild_counters(conn, user_ids = user_ids)
+    await cache.backend.invalidate(*map(cache.habits_key, user_ids))
+    return counts
+
+def main():
+    "Console entry point, exports or imports users' habits history"
+    parser = argparse.ArgumentParser(description = main.__doc__)
+    commands = parser.add_subparsers(dest = "command", required = True)
+    export = commands.add_parser("export", help = "write history into a directory")
+    export.add_argument("directory", type = Path)
+    export.add_argument("--format", choices = FORMATS, default = 'csv')
+    export.add_argument("--user", type = int, action = "append", dest = "user_ids", help = "export only this user, may be repeated")
+    export.add_argument("--chunk-size", type = int, default = CHUNK_SIZE)
+    load = commands.add_parser("import", help = "load history from a directory")
+    load.add_argument("directory", type = Path)
+    load.add_argument("--chunk-size", type = int, default = CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "export":
+        counts = asyncio.run(export_history(args.directory, args.user_ids, args.format, args.chunk_size))
+    else:
+        from habbiton.utils import fill_new_db
+        async def load():
+            await fill_new_db()
+            return await import_history(args.directory, args.chunk_size)
+        counts = asyncio.run(load())
+    print(json.dumps(counts))
@@ -1,49 +1,132 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from aiogram.filters import CommandStart
+from aiogram.client.session.base import BaseSession
+from aiogram.filters import Command, CommandObject, CommandStart
 
-from habbiton import TOKEN
+from habbiton import TOKEN, BOT_MODE, WORKERS, REMINDERS_ENABLED, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, METRICS_PORT, engine
 from habbiton.handler import Handler
+from habbiton.routes import routes
 from habbiton.models.user import User
-from habbiton import utils
+from habbiton.models.state import Level
+from habbiton import utils, webhook, sharding, reminders, metrics, cache, startup
+from habbiton.middlewares import UnitOfWorkMiddleware, UpdateMetricsMiddleware, RouteMiddleware, UserMiddleware
+from habbiton.outbound import OutboundScheduler
 
 dp = Dispatcher()
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.update.outer_middleware(UnitOfWorkMiddleware())
+dp.message.middleware(RouteMiddleware())
+dp.callback_query.middleware(RouteMiddleware())
+dp.message.middleware(UserMiddleware())
+dp.callback_query.middleware(UserMiddleware())
+metrics.instrument_engine(engine)
+
 @dp.message(CommandStart())
-async def respond_start(message) -> None:
+async def respond_start(message, user: User) -> None:
     """
     Router for handling of /start command
     """
-    user = await User.new(
-        message.from_user.id,
-        message.from_user.username
-    )
     await Handler(user, message).handle_start()
 
+@dp.message(Command("remind"))
+async def respond_remind(message, command: CommandObject, user: User, registered: bool) -> None:
+    """
+    Router for /remind command, sets time of daily reminders
+    """
+    if registered:
+        await respond_start(message, user)
+        return
+    await Handler(user, message).set_reminder(command.args)
+
+@dp.message(Command("timezone"))
+async def respond_timezone(message, command: CommandObject, user: User, registered: bool) -> None:
+    """
+    Router for /timezone command, sets timezone periods are counted in
+    """
+    if registered:
+        await respond_start(message, user)
+        return
+    await Handler(user, message).set_timezone(command.args)
+
 @dp.message()
-async def respond(message) -> None:
+async def respond(message, user: User, registered: bool) -> None:
     """
     General router for all message types
     """
-    user = await User.from_id(message.from_user.id)
-    if not user:
-        await respond_start(message)
+    if registered:
+        await respond_start(message, user)
+        return
     await Handler(user, message).handle()
 
 @dp.callback_query()
-async def respond_inline(message) -> None:
+async def respond_inline(message, user: User) -> None:
+    """
+    Router for callbacks from inline buttons, only registered routes can be called
+    """
+    call = routes.unpack(message.data)
+    if call is None:
+        # Stops the button's loading indicator, nothing else to do
+        await message.answer()
+        return
+    route, args = call
+    await route(Handler(user, message), *args)
+
+@dp.startup()
+async def on_startup(bot: Bot, worker: int = None, serve_metrics: bool = True) -> None:
+    if worker is None:
+        # In multi-process mode db and reminders are handled by the ingress process
+        await utils.fill_new_db()
+        if REMINDERS_ENABLED:
+            reminders.scheduler.start(bot)
+    await cache.backend.start()
+    await Level.reload_graph()
+    User.store.start()
+    startup.timer.mark("caches")
+    if METRICS_PORT and serve_metrics:
+        await metrics.server.start(METRICS_PORT + (worker or 0))
+    if worker is not None:
+        # Workers get updates from the ingress, they're ready now
+        startup.timer.finish()
+
+@dp.shutdown()
+async def on_shutdown() -> None:
+    await reminders.scheduler.stop()
+    await User.store.stop()
+    await cache.backend.stop()
+    await metrics.server.stop()
+
+def create_bot(token: str = TOKEN, session: BaseSession = None, scheduler: OutboundScheduler = None) -> Bot:
     """
-    Router for callbacks from inline buttons
+    Creates bot which sends requests through the rate limited outbound scheduler, one with configured rates
+    unless given. Middlewares already registered on the session run before the bot's ones.
     """
-    user = await User.from_id(message.from_user.id)
-    callback_data = message.data.split("|")
-    params = callback_data[1:]
-    await getattr(Handler(user, message), callback_data[0])(*params)
+    bot = Bot(token=token, session=session)
+    if scheduler is None:
+        # With workers the ingress sends too (reminders), it gets an equal share of the global rate
+        processes = WORKERS + 1 if WORKERS > 1 else 1
+        scheduler = OutboundScheduler(
+            global_rate = OUTBOUND_GLOBAL_RATE / processes,
+            chat_rate = OUTBOUND_CHAT_RATE,
+            chat_burst = OUTBOUND_CHAT_BURST
+        )
+    # Timer goes first, so the time requests wait in the scheduler's queue counts too
+    bot.session.middleware(metrics.ApiTimer())
+    bot.session.middleware(scheduler)
+    bot.session.middleware(startup.FirstPoll())
+    metrics.registry.add_source("outbound", scheduler.stats)
+    metrics.registry.add_source("startup_seconds", startup.timer.stats)
+    return bot
 
 async def bot() -> None:
-    await utils.fill_new_db()
-    bot = Bot(token=TOKEN)
-    await dp.start_polling(bot)
+    startup.timer.mark("imports")
+    bot = create_bot()
+    if WORKERS > 1:
+        await sharding.serve(dp, bot, WORKERS)
+    elif BOT_MODE == "webhook":
+        await webhook.serve(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 def main():
     logging.basicConfig(level=logging.INFO)
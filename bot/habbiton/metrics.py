@@ -0,0 +1,190 @@
+"""
+Per-update instrumentation. Every update gets UpdateStats in a context variable, SQL statements and
+Bot API requests made while handling it add their time there. Finished updates are aggregated into
+Prometheus metrics, served in text format on a local port, and logged when slower than a threshold.
+"""
+import json
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict, field
+from time import perf_counter
+from typing import Any, Callable
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from habbiton import METRICS_HOST, SLOW_UPDATE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+#Upper bounds of update duration histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+@dataclass
+class UpdateStats:
+    "What handling of one update took"
+    update_id: int = None
+    handler: str = "unhandled"
+    callback: str = None
+    seconds: float = 0
+    queries: int = 0
+    db_seconds: float = 0
+    api_calls: int = 0
+    api_seconds: float = 0
+    started: float = field(default_factory = perf_counter, repr = False)
+
+current = ContextVar("update_stats", default = None)
+
+def mark_callback(name: str) -> None:
+    "Records which Handler callback the update was routed to"
+    stats = current.get()
+    if stats is not None and stats.callback is None:
+        stats.callback = name
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Registry:
+    "Aggregates finished updates by handler and callback, other components add their stats as gauges"
+    def __init__(self):
+        self.updates: dict[tuple, dict] = {}
+        self.durations: dict[tuple, Histogram] = {}
+        self.slow = 0
+        self.sources: dict[str, Callable[[], dict]] = {}
+
+    def add_source(self, name: str, stats: Callable[[], dict]) -> None:
+        "Registers a function returning numeric stats, exported as habbiton_<name>_<key>"
+        self.sources[name] = stats
+
+    def clear(self) -> None:
+        self.updates.clear()
+        self.durations.clear()
+        self.slow = 0
+
+    def record(self, stats: UpdateStats) -> None:
+        labels = (stats.handler, stats.callback or "")
+        totals = self.updates.setdefault(labels, {"count": 0, "queries": 0, "db_seconds": 0, "api_calls": 0, "api_seconds": 0})
+        totals["count"] += 1
+        totals["queries"] += stats.queries
+        totals["db_seconds"] += stats.db_seconds
+        totals["api_calls"] += stats.api_calls
+        totals["api_seconds"] += stats.api_seconds
+        self.durations.setdefault(labels, Histogram()).observe(stats.seconds)
+        if stats.seconds >= SLOW_UPDATE_SECONDS:
+            self.slow += 1
+            logger.warning(f"Slow update {json.dumps({key: value for key, value in asdict(stats).items() if key != 'started'})}")
+
+    def render(self) -> str:
+        "Metrics in Prometheus text exposition format"
+        lines = []
+        def labels(handler, callback, **extra):
+            pairs = {"handler": handler, "callback": callback, **extra}
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs.items()) + "}"
+
+        counters = [
+            ("updates_total", "count", "Updates handled"),
+            ("update_queries_total", "queries", "SQL statements executed while handling updates"),
+            ("update_db_seconds_total", "db_seconds", "Time spent in SQL statements"),
+            ("update_api_requests_total", "api_calls", "Bot API requests made while handling updates"),
+            ("update_api_seconds_total", "api_seconds", "Time spent waiting for Bot API requests, including outbound queueing"),
+        ]
+        for name, key, help in counters:
+            lines += [f"# HELP habbiton_{name} {help}", f"# TYPE habbiton_{name} counter"]
+            lines += [f"habbiton_{name}{labels(*label)} {totals[key]}" for label, totals in self.updates.items()]
+
+        lines += ["# HELP habbiton_update_seconds Update handling time", "# TYPE habbiton_update_seconds histogram"]
+        for label, histogram in self.durations.items():
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f"habbiton_update_seconds_bucket{labels(*label, le = bound)} {cumulative}")
+            lines.append(f"habbiton_update_seconds_sum{labels(*label)} {histogram.sum}")
+            lines.append(f"habbiton_update_seconds_count{labels(*label)} {cumulative}")
+
+        lines += ["# HELP habbiton_slow_updates_total Updates slower than SLOW_UPDATE_SECONDS", "# TYPE habbiton_slow_updates_total counter"]
+        lines.append(f"habbiton_slow_updates_total {self.slow}")
+
+        for source, stats in self.sources.items():
+            try:
+                values = stats()
+            except Exception:
+                logger.exception(f"Failed to collect {source} stats")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines += [f"# TYPE habbiton_{source}_{key} gauge", f"habbiton_{source}_{key} {value}"]
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    # A connection runs one statement at a time
+    conn.info["query_started"] = perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    stats = current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += perf_counter() - conn.info["query_started"]
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    "Makes SQL statements of the engine count towards the update they're executed for"
+    if not event.contains(engine.sync_engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+        if hasattr(engine.pool, "stats"):
+            registry.add_source("db_pool", engine.pool.stats)
+
+class ApiTimer(BaseRequestMiddleware):
+    "Bot session middleware adding time of requests to the current update, register it before the outbound scheduler"
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        stats = current.get()
+        if stats is None:
+            return await make_request(bot, method)
+        start = perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            stats.api_calls += 1
+            stats.api_seconds += perf_counter() - start
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(body = registry.render().encode(), headers = {"Content-Type": CONTENT_TYPE})
+
+class MetricsServer:
+    "Local aiohttp server for /metrics, separate from the webhook one so it works in any mode"
+    def __init__(self):
+        self.runner = None
+
+    async def start(self, port: int, host: str = METRICS_HOST) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, host, port).start()
+        except OSError as e:
+            # Metrics are not worth failing the bot for
+            logger.error(f"Can't serve metrics on {host}:{port}: {e}")
+            await self.stop()
+            return
+        logger.info(f"Serving metrics on {host}:{port}/metrics")
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+server = MetricsServer()
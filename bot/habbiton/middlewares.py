@@ -0,0 +1,67 @@
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from habbiton.uow import unit_of_work
+from habbiton import metrics
+from habbiton.models.user import User
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    "Opens one db session per update, all model calls made by handlers share it and commit once"
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        async with unit_of_work():
+            return await handler(event, data)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    "Collects stats of every update into metrics registry, should be the outermost update middleware"
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        stats = metrics.UpdateStats(update_id = event.update_id)
+        token = metrics.current.set(stats)
+        try:
+            return await handler(event, data)
+        finally:
+            stats.seconds = perf_counter() - stats.started
+            metrics.current.reset(token)
+            metrics.registry.record(stats)
+
+class RouteMiddleware(BaseMiddleware):
+    "Inner middleware of event observers, records which router function the update was matched to"
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        stats = metrics.current.get()
+        if stats is not None:
+            stats.handler = data["handler"].callback.__name__
+        return await handler(event, data)
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Inner middleware of event observers, resolves the sender once per update and passes them to handlers
+    as user, registering new users on the way, registered tells whether they were registered just now
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        sender = data.get("event_from_user")
+        if sender is None:
+            # Nobody to handle it for
+            return None
+        data["user"], data["registered"] = await User.resolve(sender.id, sender.username)
+        return await handler(event, data)
@@ -0,0 +1,133 @@
+"""
+Versioned schema migrations. Tables of a new db are created by Base.metadata.create_all,
+migrations bring existing deployments up to the same schema in place, so every statement
+here should also be safe to run against a freshly created db.
+To change the schema, update the models and append a migration with the next version number.
+A migration step is either an SQL statement or an async function taking the connection, for data backfills.
+"""
+import logging
+from sqlalchemy import select, text, insert, update, table, column, bindparam
+from sqlalchemy.ext.asyncio import AsyncConnection
+from habbiton import streaks
+from habbiton.models.schema import SchemaVersion
+from habbiton.models.habit import PERIOD_KEY_FUNCTION, PERIOD_KEY_TRIGGER, period_key_sql
+
+logger = logging.getLogger(__name__)
+
+#Advisory lock key, so only one bot instance migrates at a time
+LOCK_KEY = 0x68616262
+
+#Tables as migrations below see them, not the models, which keep changing after them
+habits = table("habits", *map(column, ("id", "period", "created_date", *streaks.Counters._fields)))
+habit_completions = table("habit_completions", column("habit_id"), column("created_date"))
+
+async def rebuild_counters(conn: AsyncConnection, batch_size: int = 1000) -> None:
+    "Recalculates streak counters of all habits from their completions, batch by batch"
+    last_id = 0
+    while True:
+        stmt = select(habits.c.id, habits.c.period, habits.c.created_date).where(habits.c.id > last_id).order_by(habits.c.id).limit(batch_size)
+        rows = (await conn.execute(stmt)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        dates = {}
+        stmt = select(habit_completions.c.habit_id, habit_completions.c.created_date).where(habit_completions.c.habit_id.in_([row.id for row in rows]))
+        for habit_id, day in (await conn.execute(stmt)).all():
+            dates.setdefault(habit_id, []).append(day)
+        counters = [
+            {"habit_id": row.id, **streaks.rebuild_counters(row.period, row.created_date, dates.get(row.id, []))._asdict()}
+            for row in rows
+        ]
+        await conn.execute(update(habits).where(habits.c.id == bindparam("habit_id")), counters)
+
+MIGRATIONS = [
+    (1, "Indexes for hot queries, unique completion per habit and day", [
+        # Duplicates have to go before the unique index, the earliest completion is kept
+        """
+        DELETE FROM habit_completions a USING habit_completions b
+        WHERE a.habit_id = b.habit_id AND a.created_date = b.created_date AND a.id > b.id
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_habit_completions_habit_date ON habit_completions (habit_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS ix_habits_user_period_starred ON habits (user_id, period, starred)",
+        "CREATE INDEX IF NOT EXISTS ix_buttons_level_text ON buttons (current_level_name, text)",
+    ]),
+    (2, "Daily reminders about incomplete habits", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS reminder_minute integer",
+        "CREATE INDEX IF NOT EXISTS ix_users_reminder_minute ON users (reminder_minute)",
+        """
+        CREATE TABLE IF NOT EXISTS reminder_log (
+            user_id integer NOT NULL REFERENCES users (id),
+            sent_on date NOT NULL,
+            PRIMARY KEY (user_id, sent_on)
+        )
+        """,
+    ]),
+    (3, "Materialized streak counters on habits", [
+        "ALTER TABLE habits ADD COLUMN IF NOT EXISTS current_streak integer NOT NULL DEFAULT 0",
+        "ALTER TABLE habits ADD COLUMN IF NOT EXISTS longest_streak integer NOT NULL DEFAULT 0",
+        "ALTER TABLE habits ADD COLUMN IF NOT EXISTS last_period integer",
+        "ALTER TABLE habits ADD COLUMN IF NOT EXISTS total_completions integer NOT NULL DEFAULT 0",
+        rebuild_counters,
+    ]),
+    (4, "Keyset pagination of habits list", [
+        "UPDATE habits SET starred = false WHERE starred IS NULL",
+        "ALTER TABLE habits ALTER COLUMN starred SET DEFAULT false",
+        "ALTER TABLE habits ALTER COLUMN starred SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_habits_user_starred_id ON habits (user_id, starred DESC, id)",
+    ]),
+    (5, "Version of bot's levels structure, so startup can skip seeding", [
+        "ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS seed_version integer NOT NULL DEFAULT 0",
+        # Deployments with levels were seeded with the first version
+        "UPDATE schema_version SET seed_version = 1 WHERE seed_version = 0 AND EXISTS (SELECT 1 FROM levels)",
+    ]),
+    (6, "Period keys of completions, one completion per habit and period, users' timezones", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone varchar",
+        "ALTER TABLE habit_completions ADD COLUMN IF NOT EXISTS period_key integer",
+        PERIOD_KEY_FUNCTION,
+        "DROP TRIGGER IF EXISTS habit_completions_period_key ON habit_completions",
+        PERIOD_KEY_TRIGGER,
+        f"""
+        UPDATE habit_completions SET period_key = {period_key_sql("habits.period", "habit_completions.created_date")}
+        FROM habits WHERE habits.id = habit_completions.habit_id AND habit_completions.period_key IS NULL
+        """,
+        # Completions of habits without a period can't be counted anywhere
+        "DELETE FROM habit_completions WHERE period_key IS NULL",
+        # The earliest completion of a period is kept
+        """
+        DELETE FROM habit_completions a USING habit_completions b
+        WHERE a.habit_id = b.habit_id AND a.period_key = b.period_key AND (a.created_date, a.id) > (b.created_date, b.id)
+        """,
+        "ALTER TABLE habit_completions ALTER COLUMN period_key SET NOT NULL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_habit_completions_habit_period ON habit_completions (habit_id, period_key)",
+        "DROP INDEX IF EXISTS uq_habit_completions_habit_date",
+        # Duplicates counted in total completions are gone
+        rebuild_counters,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+async def migrate(conn: AsyncConnection) -> int:
+    """
+    Applies pending migrations inside the connection's transaction and returns the resulting version.
+    schema_version table should already exist.
+    """
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+    version = (await conn.execute(select(SchemaVersion.version).with_for_update())).scalar()
+    if version is None:
+        version = 0
+        await conn.execute(insert(SchemaVersion).values(id = 1, version = version))
+
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Applying migration {number}: {description}")
+        for statement in statements:
+            if callable(statement):
+                await statement(conn)
+            else:
+                await conn.execute(text(statement))
+        version = number
+
+    await conn.execute(update(SchemaVersion).where(SchemaVersion.id == 1).values(version = version))
+    return version
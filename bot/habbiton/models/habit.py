@@ -1,16 +1,44 @@
-from sqlalchemy import Column, Integer, String, Date, select, delete, ForeignKey, update, Boolean
-from habbiton import Base, session
-from sqlalchemy.orm import mapped_column
-from datetime import datetime, timedelta
+from sqlalchemy import Column, Integer, String, Date, select, delete, ForeignKey, update, Boolean, Index, and_, or_, func, bindparam, exists, literal, case, desc, event, DDL
+from sqlalchemy.dialects.postgresql import insert
+from habbiton import Base, session, HABITS_PAGE_SIZE
+from habbiton.uow import scoped_session, commit
+from habbiton import cache
+from sqlalchemy.orm import mapped_column, aliased
+from datetime import date
+from contextlib import nullcontext
+from typing import NamedTuple
+from habbiton.periods import PERIODS, period_key, local_today
+from habbiton.streaks import Streaks, Counters, keys_streaks, count_completion, rebuild_counters, counters_streaks
+
+class Cursor(NamedTuple):
+    "Position in user's habits list, which goes starred first and then by id, pages are read after or before it"
+    starred: bool
+    id: int
+    backward: bool = False
+
+class HabitsPage(NamedTuple):
+    habits: list[tuple['Habit', bool]]
+    previous: Cursor = None
+    next: Cursor = None
 
 class Habit(Base):
     __tablename__ = 'habits'
+    __table_args__ = (
+        Index("ix_habits_user_period_starred", "user_id", "period", "starred"),
+        # Keyset pagination of the habits list, see get_user_habits_page
+        Index("ix_habits_user_starred_id", "user_id", desc("starred"), "id"),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     name = mapped_column(String, nullable=False)
     user_id = mapped_column(ForeignKey("users.id"), nullable=False)
-    created_date = mapped_column(Date, nullable=True, default = datetime.now().date)
+    created_date = mapped_column(Date, nullable=True, default = local_today)
     period = mapped_column(String, nullable=True)
-    starred = mapped_column(Boolean, nullable=True, default = False)
+    starred = mapped_column(Boolean, nullable=False, default = False, server_default = "false")
+    # Streak counters kept up to date by complete(), see streaks.Counters
+    current_streak = mapped_column(Integer, nullable=False, default = 0, server_default = "0")
+    longest_streak = mapped_column(Integer, nullable=False, default = 0, server_default = "0")
+    last_period = mapped_column(Integer, nullable=True)
+    total_completions = mapped_column(Integer, nullable=False, default = 0, server_default = "0")
     session = session
     
     @classmethod
@@ -18,31 +46,34 @@ class Habit(Base):
         cls.session = session
 
     @classmethod
-    async def new(cls, name: str, user_id: int) -> None:
-        "Creates a temporary habit"
-        async with cls.session() as ses:
-            ses.add(cls(name = name, user_id = user_id))
-            await ses.commit()
+    async def new(cls, name: str, user_id: int, today: date = None) -> None:
+        "Creates a temporary habit, started today in the user's timezone"
+        async with scoped_session(cls.session) as ses:
+            ses.add(cls(name = name, user_id = user_id, created_date = today or local_today()))
+            await cache.changed(ses, cache.habits_key(user_id))
+            await commit(ses)
     
     @classmethod
     async def delete_unfinished(cls, id) -> None:
         "Deletes a temporary habit, if user decided to cancel habit creation"
-        async with cls.session() as ses:
+        async with scoped_session(cls.session) as ses:
             stmt = delete(cls).where(cls.period == None, cls.user_id == id)
             await ses.execute(stmt)
-            await ses.commit()
+            await cache.changed(ses, cache.habits_key(id))
+            await commit(ses)
     
     @classmethod
     async def set_period(cls, value, id) -> None:
         "Finishes a temporary habit, making it a normal one"
-        async with cls.session() as ses:
+        async with scoped_session(cls.session) as ses:
             stmt = update(cls).where(cls.period == None, cls.user_id == id).values(period = value)
             await ses.execute(stmt)
-            await ses.commit()
+            await cache.changed(ses, cache.habits_key(id))
+            await commit(ses)
     
     @classmethod
     async def get_user_habits(cls, user_id, type = None) -> list['Habit']:
-        async with cls.session() as ses:
+        async with scoped_session(cls.session) as ses:
             if type:
                 stmt = select(cls).where(cls.user_id == user_id, cls.period == type).order_by(cls.starred.desc())
             else:
@@ -51,107 +82,264 @@ class Habit(Base):
     
     @classmethod
     async def get_user_habit(cls, user_id, id) -> 'Habit':
-        async with cls.session() as ses:
+        "Pulls user's habit by id, from cache when it's there"
+        key = cache.habit_key(int(id))
+        habit = await cache.get_row(cls, key)
+        if habit is not None:
+            return habit if habit.user_id == user_id else None
+        async with scoped_session(cls.session) as ses:
             stmt = select(cls).where(cls.user_id == user_id, cls.id == int(id))
-            return (await ses.execute(stmt)).scalar()
+            habit = (await ses.execute(stmt)).scalar()
+        if habit is not None:
+            await cache.set_row(key, habit)
+        return habit
         
-    async def complete(self) -> None:
-        async with self.session() as ses:
-            ses.add(HabitCompletion(habit_id = self.id))
-            await ses.commit()
+    @classmethod
+    def current_completion_clause(cls, today: date, habit = None):
+        "Join condition matching habit's completion in its current period by the indexed period key, habit may be an alias"
+        habit = habit or cls
+        keys = {period: period_key(period, today) for period in PERIODS}
+        return and_(HabitCompletion.habit_id == habit.id, HabitCompletion.period_key == case(keys, value = habit.period))
+
+    @classmethod
+    async def count_user_habits(cls, user_id, type = None) -> int:
+        stmt = select(func.count()).select_from(cls).where(cls.user_id == user_id)
+        if type:
+            stmt = stmt.where(cls.period == type)
+        async with scoped_session(cls.session) as ses:
+            return (await ses.execute(stmt)).scalar()
+
+    @classmethod
+    async def get_user_habits_page(cls, user_id, type = None, cursor: Cursor = None, limit: int = None, today = None) -> HabitsPage:
+        """
+        Pulls a page of user's habits after or before the cursor together with their completion in the current period,
+        statuses are checked only for habits of the page, so it costs the same however many habits there are
+        """
+        limit = limit or HABITS_PAGE_SIZE
+        stmt = select(cls).where(cls.user_id == user_id)
+        if type:
+            stmt = stmt.where(cls.period == type)
+        backward = cursor is not None and cursor.backward
+        if cursor is not None:
+            starred = literal(cursor.starred, Boolean)
+            if backward:
+                stmt = stmt.where(or_(cls.starred > starred, and_(cls.starred == starred, cls.id < cursor.id)))
+            else:
+                stmt = stmt.where(or_(cls.starred < starred, and_(cls.starred == starred, cls.id > cursor.id)))
+        # One row more tells whether there is a page further
+        page = stmt.order_by(*cls.page_order(backward)).limit(limit + 1).subquery()
+        habit = aliased(cls, page)
+        completed = exists().where(cls.current_completion_clause(today or local_today(), habit))
+        stmt = select(habit, completed).order_by(*cls.page_order(backward, habit))
+        async with scoped_session(cls.session) as ses:
+            habits = [tuple(row) for row in (await ses.execute(stmt)).all()]
+
+        if not habits:
+            # Habits the cursor pointed at were deleted since, starting over
+            return await cls.get_user_habits_page(user_id, type, None, limit, today) if cursor else HabitsPage([])
+        further = len(habits) > limit
+        habits = habits[:limit]
+        if backward:
+            habits.reverse()
+        first, last = habits[0][0], habits[-1][0]
+        before = Cursor(first.starred, first.id, True) if (further if backward else cursor is not None) else None
+        after = Cursor(last.starred, last.id) if (backward or further) else None
+        return HabitsPage(habits, before, after)
+
+    @classmethod
+    def page_order(cls, backward = False, habit = None) -> tuple:
+        habit = habit or cls
+        if backward:
+            return habit.starred.asc(), habit.id.desc()
+        return habit.starred.desc(), habit.id.asc()
+
+    @classmethod
+    async def get_due_habits(cls, user_ids: list[int], today = None) -> dict[int, list['Habit']]:
+        "Finds habits of many users not completed yet in their current period, in one query"
+        stmt = (
+            select(cls)
+            .outerjoin(HabitCompletion, cls.current_completion_clause(today or local_today()))
+            .where(cls.user_id.in_(user_ids), cls.period != None)
+            .group_by(cls.id)
+            .having(func.count(HabitCompletion.id) == 0)
+            .order_by(cls.user_id, cls.starred.desc(), cls.id)
+        )
+        due = {}
+        async with scoped_session(cls.session) as ses:
+            for habit in (await ses.execute(stmt)).scalars():
+                due.setdefault(habit.user_id, []).append(habit)
+        return due
+
+    @classmethod
+    async def rebuild_counters(cls, conn = None, verify = False, user_ids: list[int] = None, batch_size = 1000) -> list[int]:
+        """
+        Recalculates streak counters of particular users' or all habits from their completions, batch by batch.
+        Returns ids of habits whose stored counters were wrong, with verify they're only reported, not fixed.
+        Works in a given connection or session, otherwise in its own.
+        """
+        habits, completions = cls.__table__, HabitCompletion.__table__
+        columns = Counters._fields
+        mismatched = []
+        async with scoped_session(cls.session) if conn is None else nullcontext(conn) as ses:
+            last_id = 0
+            while True:
+                stmt = (
+                    select(habits.c.id, habits.c.period, habits.c.created_date, *(habits.c[name] for name in columns))
+                    .where(habits.c.id > last_id)
+                    .order_by(habits.c.id)
+                    .limit(batch_size)
+                )
+                if user_ids is not None:
+                    stmt = stmt.where(habits.c.user_id.in_(user_ids))
+                rows = (await ses.execute(stmt)).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                dates = {}
+                stmt = select(completions.c.habit_id, completions.c.created_date).where(completions.c.habit_id.in_([row.id for row in rows]))
+                for habit_id, day in (await ses.execute(stmt)).all():
+                    dates.setdefault(habit_id, []).append(day)
+
+                fixes = []
+                for row in rows:
+                    counters = rebuild_counters(row.period, row.created_date, dates.get(row.id, []))
+                    if counters != Counters(*(row._mapping[name] for name in columns)):
+                        mismatched.append(row.id)
+                        fixes.append({"habit_id": row.id, **counters._asdict()})
+                if fixes and not verify:
+                    stmt = update(habits).where(habits.c.id == bindparam("habit_id"))
+                    await ses.execute(stmt, fixes)
+                    await cache.backend.invalidate(*(cache.habit_key(fix["habit_id"]) for fix in fixes))
+            if conn is None:
+                await commit(ses)
+        return mismatched
+
+    @property
+    def counters(self) -> Counters:
+        return Counters(self.current_streak, self.longest_streak, self.last_period, self.total_completions)
+
+    async def complete(self, today = None) -> None:
+        "Marks habit completed today and advances its streak counters, repeated completions in the same period are ignored"
+        if self.period not in PERIODS:
+            return
+        today = today or local_today()
+        async with scoped_session(self.session) as ses:
+            stmt = (
+                insert(HabitCompletion)
+                .values(habit_id = self.id, created_date = today, period_key = period_key(self.period, today))
+                .on_conflict_do_nothing(index_elements = ["habit_id", "period_key"])
+                .returning(HabitCompletion.id)
+            )
+            if (await ses.execute(stmt)).scalar() is not None:
+                # Row lock keeps concurrent completions from counting over each other
+                stmt = select(*(getattr(Habit, name) for name in Counters._fields)).where(Habit.id == self.id).with_for_update()
+                counters = count_completion(self.period, self.created_date, Counters(*(await ses.execute(stmt)).one()), today)
+                stmt = update(Habit).where(Habit.id == self.id).values(**counters._asdict())
+                await ses.execute(stmt)
+                for key, value in counters._asdict().items():
+                    setattr(self, key, value)
+            await cache.changed(ses, cache.habit_key(self.id), cache.habits_key(self.user_id))
+            await commit(ses)
+
+    def streaks(self, today = None) -> Streaks:
+        "Current and longest streak from the stored counters, no query needed"
+        return counters_streaks(self.period, self.created_date, self.counters, today)
+
+    def completed_in_current_period(self, today = None) -> bool:
+        "Checks completion in the current period by the stored counters"
+        if self.period not in PERIODS or self.last_period is None:
+            return False
+        return self.last_period == period_key(self.period, today or local_today())
     
     async def star(self) -> None:
-        async with self.session() as ses:
+        async with scoped_session(self.session) as ses:
             self.starred = not self.starred
             stmt = update(Habit).where(Habit.id == self.id).values(starred = self.starred)
             await ses.execute(stmt)
-            await ses.commit()
-
-    async def check_completion(self, today = datetime.now().date()) -> bool:
-        "Checks habit completion in the current period"
-        if self.period == 'Daily':
-            stmt = select(HabitCompletion).where(HabitCompletion.habit_id == self.id, HabitCompletion.created_date == today)
-        elif self.period == 'Weekly':
-            stmt = select(HabitCompletion).where(
-                HabitCompletion.habit_id == self.id,
-                HabitCompletion.created_date >= (today - timedelta(today.weekday())),
-                HabitCompletion.created_date < (today - timedelta(today.weekday()) + timedelta(weeks = 1))
-            )
-        elif self.period == 'Monthly':
-            if today.month == 12:
-                upper_buffer = datetime(today.year + 1, 1, 1).date()
-            else:
-                upper_buffer = datetime(today.year, today.month + 1, 1).date()
+            await cache.changed(ses, cache.habit_key(self.id), cache.habits_key(self.user_id))
+            await commit(ses)
 
-            stmt = select(HabitCompletion).where(
-                HabitCompletion.habit_id == self.id,
-                HabitCompletion.created_date >= today.replace(day=1),
-                HabitCompletion.created_date < upper_buffer
-            )
-                
-        async with self.session() as ses:
-            return True if (await ses.execute(stmt)).scalar() else False
+    async def check_completion(self, today = None) -> bool:
+        "Checks habit completion in the current period, a single lookup in the unique index of period keys"
+        if self.period not in PERIODS:
+            return False
+        key = period_key(self.period, today or local_today())
+        stmt = select(exists().where(HabitCompletion.habit_id == self.id, HabitCompletion.period_key == key))
+        async with scoped_session(self.session) as ses:
+            return (await ses.execute(stmt)).scalar()
     
     async def delete(self) -> None:
         "Deletes habit and all completions of it"
-        async with self.session() as ses:
+        async with scoped_session(self.session) as ses:
             stmt = delete(HabitCompletion).where(HabitCompletion.habit_id == self.id)
             await ses.execute(stmt)
-            await ses.commit()
+            await commit(ses)
 
             stmt = delete(Habit).where(Habit.id == self.id)
             await ses.execute(stmt)
-            await ses.commit()
+            await cache.changed(ses, cache.habit_key(self.id), cache.habits_key(self.user_id))
+            await commit(ses)
     
+    async def get_completion_dates(self) -> list[date]:
+        "Pulls dates of all habit completions with a single query"
+        async with scoped_session(self.session) as ses:
+            stmt = select(HabitCompletion.created_date).where(HabitCompletion.habit_id == self.id)
+            return (await ses.execute(stmt)).scalars().all()
+
+    async def get_completion_keys(self) -> list[int]:
+        "Pulls indexes of all completed periods, read from the index only"
+        async with scoped_session(self.session) as ses:
+            stmt = select(HabitCompletion.period_key).where(HabitCompletion.habit_id == self.id)
+            return (await ses.execute(stmt)).scalars().all()
+
+    async def calculate_streaks(self, today = None) -> Streaks:
+        "Calculates current and longest streak at once, completed periods are loaded only once"
+        return keys_streaks(self.period, self.created_date, set(await self.get_completion_keys()), today)
+
     async def calculate_streak(self) -> int:
-        "Checks completion in the current period, and periods before it, unless a missing completion is found or habit creating date is passes"
-        streak = 0
-        today = datetime.now().date()
-        while today >= self.created_date:
-            if await self.check_completion(today):
-                streak += 1
-            else:
-                if today != datetime.now().date():
-                    break
-            if self.period == 'Daily':
-                today -= timedelta(1)
-            elif self.period == 'Weekly':
-                today -= timedelta(today.weekday()) + timedelta(weeks= 1)
-            elif self.period == 'Monthly':
-                if today.month == 1:
-                    today = datetime(today.year - 1, 12, 1).date()
-                else:
-                    today = datetime(today.year, today.month - 1, 1).date()
-        return streak
+        "Counts completed periods from the current one back, unless a missing completion is found or habit creating date is passed"
+        return (await self.calculate_streaks()).current
     
     async def calculate_longest_streak(self) -> int:
-        "Checks completion in the current period, and periods before it, habit creating date is passes, tracks maximum streak seen"
-        streak = 0
-        max = 0
-        today = datetime.now().date()
-        while today >= self.created_date:
-            if await self.check_completion(today):
-                streak += 1
-            else:
-                if streak > max:
-                    max = streak
-                streak = 0
-            if self.period == 'Daily':
-                today -= timedelta(1)
-            elif self.period == 'Weekly':
-                today -= timedelta(today.weekday()) + timedelta(weeks= 1)
-            elif self.period == 'Monthly':
-                if today.month == 1:
-                    today = datetime(today.year - 1, 12, 1).date()
-                else:
-                    today = datetime(today.year, today.month - 1, 1).date()
-        if streak > max:
-            max = streak
-        return max
+        "Finds maximum streak of completed periods since habit creating date"
+        return (await self.calculate_streaks()).longest
         
 
 class HabitCompletion(Base):
     __tablename__ = 'habit_completions'
+    __table_args__ = (
+        Index("uq_habit_completions_habit_period", "habit_id", "period_key", unique = True),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     habit_id = mapped_column(ForeignKey("habits.id"), nullable=False)
-    created_date = mapped_column(Date, nullable=True, default = datetime.now().date())
\ No newline at end of file
+    created_date = mapped_column(Date, nullable=True, default = local_today)
+    # Index of the habit's period the completion belongs to, see periods.period_key, one completion per period
+    period_key = mapped_column(Integer, nullable=False)
+
+def period_key_sql(period: str, day: str) -> str:
+    "SQL expression of periods.period_key for a period and a date column"
+    ordinal = f"({day} - DATE '1970-01-01' + {date(1970, 1, 1).toordinal()})"
+    return f"""CASE {period}
+        WHEN 'Daily' THEN {ordinal}
+        WHEN 'Weekly' THEN ({ordinal} - 1) / 7
+        WHEN 'Monthly' THEN EXTRACT(YEAR FROM {day})::integer * 12 + EXTRACT(MONTH FROM {day})::integer - 1
+    END"""
+
+# Completions inserted without the key, by COPY or plain inserts, get it from their habit's period
+PERIOD_KEY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION habit_completion_period_key() RETURNS trigger AS $$
+BEGIN
+    IF NEW.period_key IS NULL THEN
+        SELECT {period_key_sql("habits.period", "NEW.created_date")} INTO NEW.period_key
+        FROM habits WHERE habits.id = NEW.habit_id;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+PERIOD_KEY_TRIGGER = """
+CREATE TRIGGER habit_completions_period_key BEFORE INSERT ON habit_completions
+FOR EACH ROW EXECUTE FUNCTION habit_completion_period_key()
+"""
+event.listen(HabitCompletion.__table__, "after_create", DDL(PERIOD_KEY_FUNCTION))
+event.listen(HabitCompletion.__table__, "after_create", DDL(PERIOD_KEY_TRIGGER))
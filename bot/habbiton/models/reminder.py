@@ -0,0 +1,42 @@
+from sqlalchemy import Date, ForeignKey, select, delete
+from sqlalchemy.dialects.postgresql import insert
+from habbiton import Base, session
+from habbiton.uow import scoped_session, commit
+from sqlalchemy.orm import mapped_column
+from datetime import date
+
+class ReminderLog(Base):
+    "Days users were already reminded on, so reminders aren't repeated after restarts or by other instances"
+    __tablename__ = 'reminder_log'
+    user_id = mapped_column(ForeignKey("users.id"), primary_key=True)
+    sent_on = mapped_column(Date, primary_key=True)
+    session = session
+
+    @classmethod
+    def set_session(cls, session) -> None:
+        cls.session = session
+
+    @classmethod
+    async def claim(cls, user_ids: list[int], day: date) -> list[int]:
+        "Marks users as reminded on the day, returns only those who weren't yet"
+        if not user_ids:
+            return []
+        async with scoped_session(cls.session) as ses:
+            stmt = (
+                insert(cls)
+                .values([{"user_id": id, "sent_on": day} for id in user_ids])
+                .on_conflict_do_nothing()
+                .returning(cls.user_id)
+            )
+            claimed = (await ses.execute(stmt)).scalars().all()
+            await commit(ses)
+            return claimed
+
+    @classmethod
+    async def release(cls, user_ids: list[int], day: date) -> None:
+        "Takes back claims of users who couldn't be reminded, so they're tried again"
+        if not user_ids:
+            return
+        async with scoped_session(cls.session) as ses:
+            await ses.execute(delete(cls).where(cls.user_id.in_(user_ids), cls.sent_on == day))
+            await commit(ses)
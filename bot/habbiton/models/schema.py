@@ -0,0 +1,10 @@
+from sqlalchemy import Integer
+from habbiton import Base
+from sqlalchemy.orm import mapped_column
+
+class SchemaVersion(Base):
+    "Single row table with the version of the latest migration applied to db and of bot's levels structure"
+    __tablename__ = 'schema_version'
+    id = mapped_column(Integer, primary_key=True, default = 1)
+    version = mapped_column(Integer, nullable=False, default = 0)
+    seed_version = mapped_column(Integer, nullable=False, default = 0, server_default = "0")
@@ -1,6 +1,11 @@
-from sqlalchemy import Column, Integer, String, select, ForeignKey
+from sqlalchemy import Column, Integer, String, select, ForeignKey, Index
 from habbiton import Base, session
+from habbiton import cache
+from habbiton.uow import scoped_session, commit
 from sqlalchemy.orm import mapped_column
+from types import MappingProxyType
+import json
+from typing import Mapping, NamedTuple
 
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 
@@ -9,44 +14,38 @@ class Level(Base):
     name = mapped_column(String, primary_key=True)
     callback = mapped_column(String, nullable=True)
     session = session
+    graph = None
 
     @classmethod
     def set_session(cls, session) -> None:
         cls.session = session
+        cls.graph = None
 
     @classmethod
-    async def from_name(cls, name: str) -> 'Level':
-        "Pulls info about level by name"
-        async with cls.session() as ses:
-            stmt = select(cls).where(cls.name == name)
-            return (await ses.execute(stmt)).scalar_one()
-        
-    async def get_messages(self):
-        "Return messages list for a particular level"
-        async with self.session() as ses:
-            stmt = select(Message).where(Message.level_name == self.name).order_by(Message.order)
-            return (await ses.execute(stmt)).scalars().all()
-        
-    async def get_buttons(self):
-        "Return buttons list for a particular level, already formatted for sending"
-        async with self.session() as ses:
-            stmt = select(Button).where(Button.current_level_name == self.name).order_by(Button.order)
-            buttons = (await ses.execute(stmt)).scalars().all()
-            if len(buttons) == 0:
-                return ReplyKeyboardRemove()
-            return ReplyKeyboardMarkup(
-                resize_keyboard = True,
-                one_time_keyboard = False,
-                keyboard = [
-                    [KeyboardButton(text = button.text)]
-                    for button in buttons
-                ]
-            )
-    async def check_button(self, text: str):
-        "Tries to find button with matchinng name on the current level"
-        async with self.session() as ses:
-            stmt = select(Button).where(Button.current_level_name == self.name, Button.text == text)
-            return (await ses.execute(stmt)).scalar()
+    async def get_graph(cls) -> 'StateGraph':
+        "Returns cached state graph, loads it on first use or once levels were invalidated"
+        if cls.graph is None:
+            await cls.reload_graph()
+        return cls.graph
+
+    @classmethod
+    async def reload_graph(cls) -> 'StateGraph':
+        "Reloads levels, messages and buttons from cache or db into a new state graph"
+        cached = await cache.backend.get(cache.LEVELS_KEY)
+        if cached is not None:
+            rows = json.loads(cached)
+            levels = [cache.load_row(cls, row) for row in rows["levels"]]
+            messages = [cache.load_row(Message, row) for row in rows["messages"]]
+            buttons = [cache.load_row(Button, row) for row in rows["buttons"]]
+        else:
+            async with scoped_session(cls.session) as ses:
+                levels = (await ses.execute(select(cls))).scalars().all()
+                messages = (await ses.execute(select(Message).order_by(Message.order))).scalars().all()
+                buttons = (await ses.execute(select(Button).order_by(Button.order))).scalars().all()
+            rows = {name: [cache.dump_row(row) for row in table] for name, table in (("levels", levels), ("messages", messages), ("buttons", buttons))}
+            await cache.backend.set(cache.LEVELS_KEY, cache.encode(rows))
+        cls.graph = StateGraph.build(levels, messages, buttons)
+        return cls.graph
 
 class Message(Base):
     __tablename__ = 'messages'
@@ -57,9 +56,79 @@ class Message(Base):
 
 class Button(Base):
     __tablename__ = 'buttons'
+    __table_args__ = (
+        Index("ix_buttons_level_text", "current_level_name", "text"),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     current_level_name = mapped_column(ForeignKey("levels.name"))
     target_level_name = mapped_column(ForeignKey("levels.name"))
     text = mapped_column(String, nullable=False)
     callback = mapped_column(String, nullable=True)
-    order = mapped_column(Integer, nullable=True)
\ No newline at end of file
+    order = mapped_column(Integer, nullable=True)
+
+def build_keyboard(buttons: list[Button]) -> ReplyKeyboardMarkup | ReplyKeyboardRemove:
+    "Formats level buttons for sending, buttons should be already ordered"
+    if len(buttons) == 0:
+        return ReplyKeyboardRemove()
+    return ReplyKeyboardMarkup(
+        resize_keyboard = True,
+        one_time_keyboard = False,
+        keyboard = [
+            [KeyboardButton(text = button.text)]
+            for button in buttons
+        ]
+    )
+
+class ButtonState(NamedTuple):
+    text: str
+    target_level_name: str
+    callback: str | None
+
+class LevelState(NamedTuple):
+    name: str
+    callback: str | None
+    messages: tuple[str, ...]
+    keyboard: ReplyKeyboardMarkup | ReplyKeyboardRemove
+
+class StateGraph:
+    "Immutable in-memory snapshot of levels, their messages and buttons, so state transitions don't hit db"
+    def __init__(self, levels: dict[str, LevelState], buttons: dict[tuple[str, str], ButtonState]):
+        self.levels: Mapping[str, LevelState] = MappingProxyType(levels)
+        self.buttons: Mapping[tuple[str, str], ButtonState] = MappingProxyType(buttons)
+
+    @classmethod
+    def build(cls, levels: list[Level], messages: list[Message], buttons: list[Button]) -> 'StateGraph':
+        "Builds a graph from level, message and button rows, messages and buttons should be already ordered"
+        level_messages = {level.name: [] for level in levels}
+        for message in messages:
+            level_messages[message.level_name].append(message.text)
+        level_buttons = {level.name: [] for level in levels}
+        for button in buttons:
+            level_buttons[button.current_level_name].append(button)
+
+        return cls(
+            levels = {
+                level.name: LevelState(
+                    name = level.name,
+                    callback = level.callback,
+                    messages = tuple(level_messages[level.name]),
+                    keyboard = build_keyboard(level_buttons[level.name])
+                ) for level in levels
+            },
+            buttons = {
+                (button.current_level_name, button.text): ButtonState(button.text, button.target_level_name, button.callback)
+                for button in buttons
+            }
+        )
+
+    def level(self, name: str) -> LevelState:
+        return self.levels[name]
+
+    def check_button(self, level_name: str, text: str) -> ButtonState | None:
+        "Tries to find button with matching name on the level"
+        return self.buttons.get((level_name, text))
+
+@cache.subscribe
+def levels_invalidated(key: str) -> None:
+    if key == cache.LEVELS_KEY:
+        Level.graph = None
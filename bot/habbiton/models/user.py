@@ -1,45 +1,223 @@
-from sqlalchemy import Integer, String, Date, select, ForeignKey, update
-from habbiton import Base, session
+from sqlalchemy import Integer, String, Date, Boolean, select, ForeignKey, update, bindparam, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from habbiton import Base, session, USER_CACHE_SIZE, USER_FLUSH_INTERVAL
+from habbiton import cache
+from habbiton.uow import scoped_session, commit, after_commit
 from sqlalchemy.orm import mapped_column
-from datetime import datetime
+from collections import OrderedDict
+from itertools import groupby
+from habbiton.periods import PeriodCalendar, local_today
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class UserStore:
+    """
+    Write-behind store of users state. Keeps recently used users in a bounded LRU, coalesces
+    their updates and writes dirty rows to db in batches on an interval and at shutdown.
+    Works only while started, otherwise User reads and writes go straight to db.
+    """
+    def __init__(self, size: int, interval: float, batch_size: int = 500):
+        self.size = size
+        self.interval = interval
+        self.batch_size = batch_size
+        self.users: OrderedDict[int, 'User'] = OrderedDict()
+        self.dirty: dict[int, dict] = {}
+        self.task = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    def start(self) -> None:
+        if not self.running:
+            self.task = asyncio.create_task(self.flush_periodically())
+
+    async def stop(self) -> None:
+        "Stops periodic flushing and writes everything that's left"
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def clear(self) -> None:
+        self.users.clear()
+        self.dirty.clear()
+
+    def get(self, id: int) -> 'User':
+        user = self.users.get(id)
+        if user is not None:
+            self.users.move_to_end(id)
+        return user
+
+    def put(self, user: 'User') -> 'User':
+        "Caches user, values not yet flushed to db are applied on top of it"
+        for key, value in self.dirty.get(user.id, {}).items():
+            setattr(user, key, value)
+        self.users[user.id] = user
+        self.users.move_to_end(user.id)
+        while len(self.users) > self.size:
+            # Evicted users' pending values stay in self.dirty until the next flush
+            self.users.popitem(last = False)
+        return user
+
+    def evict(self, id: int) -> None:
+        "Drops cached user, pending values are kept"
+        self.users.pop(id, None)
+
+    def mark(self, id: int, values: dict) -> None:
+        self.dirty.setdefault(id, {}).update(values)
+
+    async def flush(self, ids: list[int] = None) -> None:
+        """
+        Writes pending updates of particular users or everyone, one batched statement per chunk.
+        Inside a unit of work rows are written in its transaction, so they're committed together with the update.
+        """
+        ids = [id for id in (list(self.dirty) if ids is None else ids) if id in self.dirty]
+        for start in range(0, len(ids), self.batch_size):
+            rows = [{"user_id": id, **self.dirty.pop(id)} for id in ids[start:start + self.batch_size]]
+            try:
+                async with scoped_session(User.session) as ses:
+                    # Rows updating the same columns go into one executemany
+                    for _, group in groupby(sorted(rows, key = sorted), key = sorted):
+                        stmt = update(User.__table__).where(User.__table__.c.id == bindparam("user_id"))
+                        await ses.execute(stmt, list(group))
+                    await commit(ses)
+            except Exception:
+                # Keep failed values unless newer ones came while writing
+                for row in rows:
+                    id = row.pop("user_id")
+                    self.dirty[id] = {**row, **self.dirty.get(id, {})}
+                raise
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush users state")
 
 class User(Base):
     __tablename__ = 'users'
     id = mapped_column(Integer, primary_key=True)
     username = mapped_column(String, nullable=True)
-    start_date = mapped_column(Date, nullable=True, default = datetime.now().date())
+    start_date = mapped_column(Date, nullable=True, default = local_today)
     current_level = mapped_column(ForeignKey("levels.name"), nullable=False,  default="main")
     latest_msg_id = mapped_column(Integer, nullable=True)
+    # Minute of the day (UTC) to remind about incomplete habits at, no reminders if empty
+    reminder_minute = mapped_column(Integer, nullable=True, index=True)
+    # IANA name of the timezone periods are counted in, UTC if empty
+    timezone = mapped_column(String, nullable=True)
     session = session
+    store = UserStore(USER_CACHE_SIZE, USER_FLUSH_INTERVAL)
 
     @classmethod
     def set_session(cls, session) -> None:
         cls.session = session
+        cls.store.clear()
+
+    @classmethod
+    async def cached(cls, id: int) -> 'User':
+        "Pulls user from the store or the shared cache, None if neither has them"
+        if cls.store.running:
+            user = cls.store.get(id)
+            if user is not None:
+                return user
+        user = await cache.get_row(cls, cache.user_key(id))
+        if user is not None and cls.store.running:
+            cls.store.put(user)
+        return user
 
     @classmethod
     async def from_id(cls, id: int) -> 'User':
         "Pulls user ins with particular telegram id"
-        async with cls.session() as ses:
+        user = await cls.cached(id)
+        if user is not None:
+            return user
+        async with scoped_session(cls.session) as ses:
             stmt = select(cls).where(cls.id == id)
-            return (await ses.execute(stmt)).scalar()
-        
+            user = (await ses.execute(stmt)).scalar()
+            if user is not None:
+                # Cached users outlive the session, so they're detached from it
+                ses.expunge(user)
+                await cache.set_row(cache.user_key(id), user)
+        if user is not None and cls.store.running:
+            cls.store.put(user)
+        return user
+
     @classmethod
-    async def new(cls, id: int, name: str) -> 'User':
-        "Creates new user entity with particular telegram id and name"
-        try:
-            async with cls.session() as ses:
-                ses.add(cls(id = id, username = name))
-                await ses.commit()
-        except:
-            pass
-        
-        return await cls.from_id(id)
-    
-    async def update(self, **kwargs) -> None:
+    async def resolve(cls, id: int, name: str = None) -> tuple['User', bool]:
+        """
+        Pulls user with particular telegram id, registering them if they're new, and keeps their name up to date.
+        Cached users cost no query, others one upsert. Returns the user and whether they were registered just now.
+        """
+        user = await cls.cached(id)
+        if user is not None:
+            if user.username != name:
+                await user.update(username = name)
+            return user, False
+
+        stmt = (
+            insert(cls)
+            .values(id = id, username = name, start_date = local_today(), current_level = "main")
+            .on_conflict_do_update(index_elements = [cls.id], set_ = {"username": name})
+            # xmax of a row updated on conflict holds the updating transaction, it's 0 only for inserted rows
+            .returning(cls, literal_column("xmax = 0", Boolean))
+            .execution_options(populate_existing = True)
+        )
+        async with scoped_session(cls.session) as ses:
+            user, registered = (await ses.execute(stmt)).one()
+            ses.expunge(user)
+            # Not cached until the registration is committed
+            after_commit(ses, lambda: cache.set_row(cache.user_key(id), user))
+            await commit(ses)
+        if cls.store.running:
+            cls.store.put(user)
+        return user, registered
+
+    @classmethod
+    async def get_reminder_bucket(cls, minute: int) -> dict[int, str]:
+        "Timezones of users who want to be reminded at particular minute of the day, by their ids"
+        async with scoped_session(cls.session) as ses:
+            stmt = select(cls.id, cls.timezone).where(cls.reminder_minute == minute)
+            return dict((await ses.execute(stmt)).all())
+
+    @property
+    def calendar(self) -> PeriodCalendar:
+        return PeriodCalendar(self.timezone)
+
+    async def update(self, flush: bool = False, **kwargs) -> None:
+        "Updates user's state, while the store is running db write is deferred unless flush is requested"
         for key, value in kwargs.items():
             setattr(self, key, value)
-        async with self.session() as ses:
+        key = cache.user_key(self.id)
+        if self.store.running:
+            self.store.mark(self.id, kwargs)
+            if flush:
+                await self.store.flush([self.id])
+            # Other instances read the new state from cache before it's in db
+            cached = self.store.users.get(self.id) is self
+            await cache.set_row(key, self)
+            await cache.backend.publish(key)
+            if cached:
+                # Publishing dropped it from the store too, it's still the latest copy here
+                self.store.put(self)
+            return
+        async with scoped_session(self.session) as ses:
             stm = update(User).where(User.id == self.id).values(**kwargs)
             await ses.execute(stm)
-            await ses.commit()
-    
\ No newline at end of file
+            await cache.changed(ses, key)
+            await commit(ses)
+
+@cache.subscribe
+def user_invalidated(key: str) -> None:
+    kind, _, id = key.partition(":")
+    if kind == "user":
+        User.store.evict(int(id))
+
@@ -0,0 +1,274 @@
+"""
+Outbound Bot API scheduler. Every request addressed to a chat is queued and sent within per-chat
+and global rate limits, so flood limits are not hit under load; 429 responses pause the chat for
+retry_after seconds and the request is retried. When several chats get 429 at once the limit is the
+bot-wide one, so all chats are paused. Requests of one chat are sent in order, one at a time,
+across chats interactive replies go before background traffic. The update's unit of work is committed
+before its requests are queued, so no connection or row lock is held while they wait.
+"""
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from itertools import count
+from time import monotonic
+from typing import Any
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage, TelegramMethod
+
+from habbiton import uow
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+#Priority of requests made in the current context, replies to users are interactive by default
+priority = ContextVar("outbound_priority", default = INTERACTIVE)
+#Whether consecutive texts queued for the same chat may be sent as one message
+merging = ContextVar("outbound_merging", default = False)
+
+MAX_TEXT_LENGTH = 4096
+MAX_RETRIES = 3
+#Chats rate limits are tracked for, above that idle ones are forgotten
+PRUNE_THRESHOLD = 10000
+#429 responses to that many chats within FLOOD_WINDOW seconds pause all of them
+GLOBAL_FLOOD_CHATS = 2
+FLOOD_WINDOW = 1
+
+@contextmanager
+def background():
+    "Requests made inside are sent after interactive ones"
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+@contextmanager
+def mergeable():
+    "Texts sent inside may be merged with the neighbouring ones queued for the same chat"
+    token = merging.set(True)
+    try:
+        yield
+    finally:
+        merging.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0
+
+    def delay(self) -> float:
+        "Seconds until a request can be made"
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+@dataclass
+class Outbound:
+    priority: int
+    seq: int
+    method: TelegramMethod
+    make_request: NextRequestMiddlewareType
+    bot: Bot
+    merge: bool
+    future: asyncio.Future
+    enqueued: float = field(default_factory = monotonic)
+    retries: int = 0
+
+@dataclass
+class OutboundMetrics:
+    sent: int = 0
+    merged: int = 0
+    retries: int = 0
+    global_pauses: int = 0
+    failed: int = 0
+    latency_seconds_total: float = 0
+    latency_seconds_max: float = 0
+
+class OutboundScheduler(BaseRequestMiddleware):
+    "Bot session middleware queueing requests made to chats, see module docs"
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats: dict[Any, deque[Outbound]] = {}
+        self.buckets: dict[Any, TokenBucket] = {}
+        # When chats last got 429, within FLOOD_WINDOW
+        self.floods: dict[Any, float] = {}
+        # Chats with a request in flight, their next request waits for it
+        self.busy: set = set()
+        self.sending: set[asyncio.Task] = set()
+        self.seq = count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.metrics = OutboundMetrics()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.chats.values())
+
+    def stats(self) -> dict:
+        return {"queue_depth": self.depth, **asdict(self.metrics)}
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        # Db work of the update is done by now, its transaction shouldn't wait in the queue
+        await uow.release()
+
+        request = Outbound(
+            priority = priority.get(),
+            seq = next(self.seq),
+            method = method,
+            make_request = make_request,
+            bot = bot,
+            merge = merging.get() and isinstance(method, SendMessage),
+            future = asyncio.get_running_loop().create_future()
+        )
+        self.chats.setdefault(chat_id, deque()).append(request)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+        return await request.future
+
+    def bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.buckets[chat_id]
+
+    def pick(self) -> tuple[Any, float]:
+        "Finds chat whose next request goes first, or returns None with time to wait"
+        best = None
+        wait = None
+        for chat_id, queue in self.chats.items():
+            if chat_id in self.busy:
+                continue
+            delay = self.bucket(chat_id).delay()
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = queue[0]
+            if best is None or (head.priority, head.seq) < (self.chats[best][0].priority, self.chats[best][0].seq):
+                best = chat_id
+        if best is not None:
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                return None, delay
+        return best, wait
+
+    def take(self, chat_id) -> list[Outbound]:
+        "Takes the next request of the chat together with texts it can be merged with"
+        queue = self.chats[chat_id]
+        batch = [queue.popleft()]
+        first = batch[0]
+        length = len(first.method.text) if first.merge else 0
+        while first.merge and queue and queue[0].merge:
+            method = queue[0].method
+            if method.reply_markup != first.method.reply_markup or method.parse_mode != first.method.parse_mode:
+                break
+            length += 2 + len(method.text)
+            if length > MAX_TEXT_LENGTH:
+                break
+            batch.append(queue.popleft())
+        if not queue:
+            del self.chats[chat_id]
+        return batch
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            chat_id, wait = self.pick()
+            if chat_id is None:
+                if not self.chats and not self.busy:
+                    # Nothing left, the next request starts a new loop
+                    self.prune()
+                    return
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.bucket(chat_id).take()
+            self.global_bucket.take()
+            self.busy.add(chat_id)
+            task = asyncio.create_task(self.send(chat_id, self.take(chat_id)))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+            if len(self.buckets) > PRUNE_THRESHOLD:
+                self.prune()
+
+    def prune(self) -> None:
+        "Forgets rate limits of idle chats which are back to full burst"
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.chats and chat_id not in self.busy and bucket.delay() == 0 and bucket.tokens >= bucket.burst:
+                del self.buckets[chat_id]
+
+    async def send(self, chat_id, batch: list[Outbound]) -> None:
+        first = batch[0]
+        method = first.method
+        if len(batch) > 1:
+            method = method.model_copy(update = {"text": "\n\n".join(request.method.text for request in batch)})
+            self.metrics.merged += len(batch) - 1
+        try:
+            result = await first.make_request(first.bot, method)
+        except TelegramRetryAfter as e:
+            self.bucket(chat_id).pause(e.retry_after)
+            self.flooded(chat_id, e.retry_after)
+            self.metrics.retries += 1
+            if first.retries < MAX_RETRIES:
+                logger.warning(f"Flood limit for chat {chat_id}, retrying in {e.retry_after}s")
+                for request in batch:
+                    request.retries += 1
+                self.chats.setdefault(chat_id, deque()).extendleft(reversed(batch))
+            else:
+                self.fail(batch, e)
+        except Exception as e:
+            self.fail(batch, e)
+        else:
+            now = monotonic()
+            for request in batch:
+                latency = now - request.enqueued
+                self.metrics.sent += 1
+                self.metrics.latency_seconds_total += latency
+                self.metrics.latency_seconds_max = max(self.metrics.latency_seconds_max, latency)
+                if not request.future.done():
+                    request.future.set_result(result)
+        finally:
+            self.busy.discard(chat_id)
+            self.wakeup.set()
+
+    def flooded(self, chat_id, retry_after: float) -> None:
+        "Pauses all chats if others got 429 recently too, one chat over its own limit doesn't stop the rest"
+        now = monotonic()
+        self.floods[chat_id] = now
+        for other, since in list(self.floods.items()):
+            if now - since > FLOOD_WINDOW:
+                del self.floods[other]
+        if len(self.floods) >= GLOBAL_FLOOD_CHATS:
+            logger.warning(f"Flood limit for {len(self.floods)} chats at once, pausing all for {retry_after}s")
+            self.global_bucket.pause(retry_after)
+            self.metrics.global_pauses += 1
+            self.floods.clear()
+
+    def fail(self, batch: list[Outbound], error: Exception) -> None:
+        self.metrics.failed += len(batch)
+        for request in batch:
+            if not request.future.done():
+                request.future.set_exception(error)
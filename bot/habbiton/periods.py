@@ -0,0 +1,63 @@
+from datetime import date, datetime, timezone
+from typing import NamedTuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+PERIODS = ('Daily', 'Weekly', 'Monthly')
+
+def period_key(period: str, day: date) -> int:
+    "Maps a date to the index of the Daily/Weekly/Monthly period it belongs to, consecutive periods get consecutive indexes"
+    if period == 'Daily':
+        return day.toordinal()
+    if period == 'Weekly':
+        # date(1, 1, 1) is a Monday, so weeks start on Mondays like in check_completion
+        return (day.toordinal() - 1) // 7
+    if period == 'Monthly':
+        return day.year * 12 + day.month - 1
+    raise ValueError(f"Unknown period: {period}")
+
+def period_start(period: str, key: int) -> date:
+    "Returns the first day of a period with particular index"
+    if period == 'Daily':
+        return date.fromordinal(key)
+    if period == 'Weekly':
+        return date.fromordinal(key * 7 + 1)
+    if period == 'Monthly':
+        return date(key // 12, key % 12 + 1, 1)
+    raise ValueError(f"Unknown period: {period}")
+
+def period_bounds(period: str, day: date) -> tuple[date, date]:
+    "Returns [start, end) range of the period containing the date"
+    key = period_key(period, day)
+    return period_start(period, key), period_start(period, key + 1)
+
+def first_full_period(period: str, created_date: date) -> int:
+    "Index of the first period starting on or after the date, a partial period at creation is not counted"
+    key = period_key(period, created_date)
+    if period_start(period, key) < created_date:
+        key += 1
+    return key
+
+def local_today(tz: str = None, now: datetime = None) -> date:
+    "Current date in the IANA timezone, UTC when it's not set, taken on every call. Naive times are UTC"
+    now = now or datetime.now(timezone.utc)
+    if now.tzinfo is None:
+        now = now.replace(tzinfo = timezone.utc)
+    return now.astimezone(ZoneInfo(tz) if tz else timezone.utc).date()
+
+def valid_timezone(tz: str) -> bool:
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+class PeriodCalendar(NamedTuple):
+    "Periods as a user sees them, the current date is taken in their timezone whenever it's asked for"
+    timezone: str = None
+
+    def today(self, now: datetime = None) -> date:
+        return local_today(self.timezone, now)
+
+    def key(self, period: str, day: date = None) -> int:
+        "Index of the period containing the day, the current one by default"
+        return period_key(period, day or self.today())
@@ -0,0 +1,48 @@
+from dataclasses import dataclass, asdict
+from time import perf_counter
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+@dataclass
+class PoolMetrics:
+    checkouts: int = 0
+    # Connections opened above pool_size, they are closed again once returned
+    overflow_connections: int = 0
+    timeouts: int = 0
+    wait_seconds_total: float = 0
+    wait_seconds_max: float = 0
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    "Connection pool which tracks how long checkouts wait and how often they overflow"
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        event.listen(self, "connect", self.on_connect)
+
+    def on_connect(self, dbapi_connection, connection_record) -> None:
+        if self.overflow() > 0:
+            self.metrics.overflow_connections += 1
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            waited = perf_counter() - start
+            self.metrics.wait_seconds_total += waited
+            self.metrics.wait_seconds_max = max(self.metrics.wait_seconds_max, waited)
+        self.metrics.checkouts += 1
+        return connection
+
+    def stats(self) -> dict:
+        "Live pool state together with accumulated metrics"
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": max(self.overflow(), 0),
+            **asdict(self.metrics)
+        }
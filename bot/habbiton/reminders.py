@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from habbiton import REMINDER_CONCURRENCY
+from habbiton import outbound
+from habbiton.models.habit import Habit
+from habbiton.models.reminder import ReminderLog
+from habbiton.models.user import User
+from habbiton.periods import local_today
+
+logger = logging.getLogger(__name__)
+
+def format_reminder(habits: list[Habit]) -> str:
+    text = "Don't forget about your habits:\n"
+    for habit in habits:
+        text += f"\n{'⭐ ' if habit.starred else ''}{habit.name} ({habit.period.lower()})"
+    return text
+
+class ReminderScheduler:
+    """
+    Every minute reminds users who picked that minute about their habits not completed in the current period.
+    Users are looked up by the indexed minute, so only the due bucket is read. Each user is claimed in
+    reminder_log before sending, which keeps reminders once a day across restarts and instances,
+    claims of users whose reminder failed are released, so they're tried again.
+    Minutes missed while the bot was down are caught up within catchup_minutes.
+    """
+    def __init__(self, concurrency: int = REMINDER_CONCURRENCY, batch_size: int = 500, catchup_minutes: int = 5):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.catchup_minutes = catchup_minutes
+        self.bot = None
+        self.task = None
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        last = now - timedelta(minutes=self.catchup_minutes)
+        while True:
+            now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+            while last < now:
+                last += timedelta(minutes=1)
+                try:
+                    await self.remind(last)
+                except Exception:
+                    logger.exception(f"Failed to send reminders for {last:%H:%M}")
+            next_minute = now + timedelta(minutes=1)
+            await asyncio.sleep((next_minute - datetime.now(timezone.utc)).total_seconds())
+
+    async def remind(self, moment: datetime) -> int:
+        "Sends reminders due at the minute, returns number of reminded users"
+        timezones = await User.get_reminder_bucket(moment.hour * 60 + moment.minute)
+        user_ids = list(timezones)
+        slots = asyncio.Semaphore(self.concurrency)
+        reminded = 0
+        for start in range(0, len(user_ids), self.batch_size):
+            claimed = await ReminderLog.claim(user_ids[start:start + self.batch_size], moment.date())
+            # Current periods are counted in users' timezones, so users of one timezone are checked together
+            by_timezone = {}
+            for user_id in claimed:
+                by_timezone.setdefault(timezones[user_id], []).append(user_id)
+            due = {}
+            for tz, ids in by_timezone.items():
+                due.update(await Habit.get_due_habits(ids, local_today(tz, moment)))
+            results = await asyncio.gather(*[
+                self.send(slots, user_id, habits) for user_id, habits in due.items()
+            ], return_exceptions=True)
+            failed = []
+            for user_id, result in zip(due, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to remind user {user_id}", exc_info=result)
+                if result is True:
+                    reminded += 1
+                else:
+                    failed.append(user_id)
+            await ReminderLog.release(failed, moment.date())
+        return reminded
+
+    async def send(self, slots: asyncio.Semaphore, user_id: int, habits: list[Habit]) -> bool:
+        async with slots:
+            with outbound.background():
+                try:
+                    await self.bot.send_message(user_id, format_reminder(habits))
+                    return True
+                except TelegramAPIError as e:
+                    # Most often the user has blocked the bot
+                    logger.warning(f"Failed to remind user {user_id}: {e}")
+                    return False
+
+scheduler = ReminderScheduler()
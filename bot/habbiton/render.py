@@ -0,0 +1,70 @@
+"""
+Cache of rendered habit screens, texts with their inline keyboards. Renders are kept per user
+under the version of their habits, every write to the user's habits or completions publishes
+cache.habits_key, which bumps it on all instances, once right away and once again after commit,
+so renders made from data read in between are dropped too. Each user keeps only the most recently
+used renders, keys include the day and the page, so old ones would otherwise pile up until a change.
+"""
+from collections import OrderedDict
+from itertools import count
+from typing import Any, Awaitable, Callable, Hashable
+
+from habbiton import RENDER_CACHE_SIZE, RENDER_CACHE_USER_SIZE
+from habbiton.cache import subscribe
+
+class UserRenders:
+    __slots__ = ("version", "renders")
+
+    def __init__(self, version: int):
+        self.version = version
+        self.renders: OrderedDict[Hashable, Any] = OrderedDict()
+
+class RenderCache:
+    def __init__(self, size: int, user_size: int = RENDER_CACHE_USER_SIZE):
+        self.size = size
+        self.user_size = user_size
+        self.users: OrderedDict[int, UserRenders] = OrderedDict()
+        # Versions are never reused, so a render started before eviction can't be stored after it
+        self.versions = count(1)
+
+    def clear(self) -> None:
+        self.users.clear()
+
+    def entry(self, user_id: int) -> UserRenders:
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = UserRenders(next(self.versions))
+            while len(self.users) > self.size:
+                self.users.popitem(last = False)
+        else:
+            self.users.move_to_end(user_id)
+        return entry
+
+    async def get(self, user_id: int, key: Hashable, render: Callable[[], Awaitable[Any]]) -> Any:
+        "Returns cached render of the key, or renders and caches it unless user's habits changed meanwhile"
+        entry = self.entry(user_id)
+        if key in entry.renders:
+            entry.renders.move_to_end(key)
+            return entry.renders[key]
+        version = entry.version
+        result = await render()
+        entry = self.users.get(user_id)
+        if entry is not None and entry.version == version:
+            entry.renders[key] = result
+            while len(entry.renders) > self.user_size:
+                entry.renders.popitem(last = False)
+        return result
+
+    def invalidate(self, user_id: int) -> None:
+        entry = self.users.get(user_id)
+        if entry is not None:
+            entry.version = next(self.versions)
+            entry.renders.clear()
+
+cache = RenderCache(RENDER_CACHE_SIZE)
+
+@subscribe
+def habits_invalidated(key: str) -> None:
+    kind, _, user_id = key.partition(":")
+    if kind == "habits":
+        cache.invalidate(int(user_id))
@@ -0,0 +1,232 @@
+"""
+Callback routing table. Handler callbacks are registered once at import together with codecs of
+their arguments, so only registered callbacks can be reached from updates and arguments arrive
+already converted. Inline buttons carry a compact callback_data: route code and binary encoded
+arguments in base64, which leaves room for more parameters within Telegram's 64 bytes.
+Text callback_data of buttons sent before, like "info|12", is still understood.
+"""
+import inspect
+import logging
+from abc import ABC, abstractmethod
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from habbiton import metrics
+
+logger = logging.getLogger(__name__)
+
+#Marks compact callback_data, never appears in text one
+PREFIX = "!"
+MAX_CALLBACK_DATA = 64
+
+class Codec(ABC):
+    "Converts argument of a route from text callback_data and to/from compact binary one"
+    @abstractmethod
+    def parse(self, text: str) -> Any:
+        ...
+
+    @abstractmethod
+    def dump(self, value) -> bytes:
+        ...
+
+    @abstractmethod
+    def load(self, data: bytes, pos: int) -> tuple[Any, int]:
+        "Decodes the value starting at pos, returns it with position right after it"
+
+def dump_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def load_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+class IntCodec(Codec):
+    "Integer as zigzag varint, small ids take a byte or two"
+    def parse(self, text: str) -> int:
+        return int(text)
+
+    def dump(self, value: int) -> bytes:
+        return dump_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+    def load(self, data: bytes, pos: int) -> tuple[int, int]:
+        value, pos = load_varint(data, pos)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+class StrCodec(Codec):
+    "Length prefixed utf-8 string"
+    def parse(self, text: str) -> str:
+        return text
+
+    def dump(self, value: str) -> bytes:
+        encoded = value.encode()
+        return dump_varint(len(encoded)) + encoded
+
+    def load(self, data: bytes, pos: int) -> tuple[str, int]:
+        length, pos = load_varint(data, pos)
+        if pos + length > len(data):
+            raise ValueError("Truncated string")
+        return data[pos:pos + length].decode(), pos + length
+
+class FlagCodec(Codec):
+    "Boolean, written as y/n in text callback_data"
+    def parse(self, text: str) -> bool:
+        if text not in ('y', 'n'):
+            raise ValueError(f"Not a flag: {text}")
+        return text == 'y'
+
+    def dump(self, value: bool) -> bytes:
+        return b"\x01" if value else b"\x00"
+
+    def load(self, data: bytes, pos: int) -> tuple[bool, int]:
+        return bool(data[pos]), pos + 1
+
+class ChoiceCodec(Codec):
+    "One of fixed values or None, stored as its index"
+    NONE = 0xff
+
+    def __init__(self, *choices: str):
+        self.choices = choices
+
+    def parse(self, text: str) -> str:
+        if text == "":
+            return None
+        if text not in self.choices:
+            raise ValueError(f"Unknown choice: {text}")
+        return text
+
+    def dump(self, value: str) -> bytes:
+        return bytes([self.NONE if value is None else self.choices.index(value)])
+
+    def load(self, data: bytes, pos: int) -> tuple[str, int]:
+        if data[pos] == self.NONE:
+            return None, pos + 1
+        return self.choices[data[pos]], pos + 1
+
+class TupleCodec(Codec):
+    "Several values as one argument, comma separated in text callback_data"
+    def __init__(self, *codecs: Codec):
+        self.codecs = codecs
+
+    def parse(self, text: str) -> tuple:
+        parts = text.split(",")
+        if len(parts) != len(self.codecs):
+            raise ValueError(f"Expected {len(self.codecs)} values: {text}")
+        return tuple(codec.parse(part) for codec, part in zip(self.codecs, parts))
+
+    def dump(self, value: tuple) -> bytes:
+        return b"".join(codec.dump(item) for codec, item in zip(self.codecs, value, strict = True))
+
+    def load(self, data: bytes, pos: int) -> tuple[tuple, int]:
+        values = []
+        for codec in self.codecs:
+            value, pos = codec.load(data, pos)
+            values.append(value)
+        return tuple(values), pos
+
+INT = IntCodec()
+STR = StrCodec()
+FLAG = FlagCodec()
+
+@dataclass(frozen = True)
+class Route:
+    name: str
+    # Identifies the route in compact callback_data, routes without it can't be called from inline buttons
+    code: int
+    callback: Callable
+    codecs: tuple[Codec, ...]
+    required: int
+
+    async def __call__(self, handler, *args) -> Any:
+        metrics.mark_callback(self.name)
+        return await self.callback(handler, *args)
+
+class RoutingTable:
+    def __init__(self):
+        self.by_name: dict[str, Route] = {}
+        self.by_code: dict[int, Route] = {}
+
+    def route(self, code: int = None, *codecs: Codec) -> Callable:
+        """
+        Registers a Handler method under its name, arguments are converted by codecs in order.
+        Code has to stay the same for the route, buttons sent before keep it.
+        """
+        def register(callback):
+            parameters = list(inspect.signature(callback).parameters.values())[1:]
+            if len(parameters) != len(codecs):
+                raise TypeError(f"{callback.__name__} takes {len(parameters)} arguments, {len(codecs)} codecs given")
+            if code is not None and (not 0 <= code < 256 or code in self.by_code):
+                raise ValueError(f"Route code {code} is invalid or taken")
+            required = sum(parameter.default is inspect.Parameter.empty for parameter in parameters)
+            route = Route(callback.__name__, code, callback, codecs, required)
+            self.by_name[route.name] = route
+            if code is not None:
+                self.by_code[code] = route
+            return callback
+        return register
+
+    async def call(self, handler, name: str) -> None:
+        "Calls level's or button's callback, which takes no arguments, unknown names are logged and skipped"
+        route = self.by_name.get(name)
+        if route is None or route.required:
+            logger.warning(f"Callback {name} is not a registered route without arguments")
+            return
+        await route(handler)
+
+    def pack(self, name: str, *args) -> str:
+        "Builds compact callback_data calling the route with arguments, trailing Nones are left to defaults"
+        route = self.by_name[name]
+        while args and args[-1] is None:
+            args = args[:-1]
+        if route.code is None:
+            raise ValueError(f"Route {name} can't be called from inline buttons")
+        data = bytes([route.code]) + b"".join(codec.dump(arg) for codec, arg in zip(route.codecs, args))
+        packed = PREFIX + urlsafe_b64encode(data).rstrip(b"=").decode()
+        if len(packed.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f"Callback data of {name} is longer than {MAX_CALLBACK_DATA} bytes")
+        return packed
+
+    def unpack(self, callback_data: str) -> tuple[Route, list]:
+        "Finds route and its arguments in callback_data of either format, None if it doesn't call a known route"
+        try:
+            if callback_data.startswith(PREFIX):
+                encoded = callback_data[len(PREFIX):]
+                data = urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+                route = self.by_code.get(data[0])
+                if route is None:
+                    return None
+                args, pos = [], 1
+                for codec in route.codecs:
+                    if pos == len(data):
+                        break
+                    arg, pos = codec.load(data, pos)
+                    args.append(arg)
+                if pos != len(data):
+                    return None
+            else:
+                name, *params = callback_data.split("|")
+                route = self.by_name.get(name)
+                if route is None or route.code is None or len(params) > len(route.codecs):
+                    return None
+                args = [codec.parse(param) for codec, param in zip(route.codecs, params)]
+        except (ValueError, IndexError):
+            return None
+        if len(args) < route.required:
+            return None
+        return route, args
+
+routes = RoutingTable()
@@ -0,0 +1,163 @@
+"""
+Multi-process mode. One ingress process receives updates with polling or webhook and forwards them
+to worker processes, picked by sender's id, so updates of one user are always handled in order by
+the same worker. Every worker runs its own event loop, db engine and caches.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import Any, Awaitable, Callable
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+
+from habbiton import BOT_MODE, REMINDERS_ENABLED, WORKER_QUEUE_SIZE, WORKER_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+#Spawned workers import everything anew instead of sharing the ingress engine and caches
+context = multiprocessing.get_context("spawn")
+
+class WorkerPool:
+    "Starts worker processes, forwards updates to them and restarts the ones that died"
+    def __init__(self, workers: int, queue_size: int = WORKER_QUEUE_SIZE):
+        self.queues = [context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        # Keeps puts into one queue in arrival order while waiting for a free slot
+        self.locks = [asyncio.Lock() for _ in range(workers)]
+        self.supervisor = None
+
+    def shard(self, user_id: int) -> int:
+        return user_id % len(self.queues)
+
+    def spawn(self, index: int) -> None:
+        process = context.Process(target = run_worker, args = (index, self.queues[index]), name = f"habbiton-worker-{index}", daemon = True)
+        process.start()
+        self.processes[index] = process
+
+    def start(self) -> None:
+        for index in range(len(self.queues)):
+            self.spawn(index)
+        self.supervisor = asyncio.create_task(self.supervise())
+
+    async def supervise(self, interval: float = 1) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self.spawn(index)
+
+    async def dispatch(self, user_id: int, update: dict) -> None:
+        "Forwards update to the worker of its user, waits while the worker's queue is full"
+        index = self.shard(user_id)
+        async with self.locks[index]:
+            await asyncio.to_thread(self.queues[index].put, (user_id, update))
+
+    async def stop(self, timeout: float = 30) -> None:
+        "Lets workers finish queued updates and stop"
+        if self.supervisor:
+            self.supervisor.cancel()
+        for index, queue in enumerate(self.queues):
+            async with self.locks[index]:
+                await asyncio.to_thread(queue.put, None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+class ShardingMiddleware(BaseMiddleware):
+    "Ingress middleware, forwards raw updates to workers instead of handling them"
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        await self.pool.dispatch(user.id if user else 0, event.model_dump(mode = "json", exclude_unset = True))
+
+async def serve(dp: Dispatcher, bot: Bot, workers: int) -> None:
+    "Runs ingress for dp, which is handled in worker processes"
+    from habbiton import utils, webhook, reminders
+
+    pool = WorkerPool(workers)
+    ingress = Dispatcher()
+    ingress.update.outer_middleware(ShardingMiddleware(pool))
+
+    @ingress.startup()
+    async def on_startup() -> None:
+        # Db and reminders are handled once here, workers only load their caches
+        await utils.fill_new_db()
+        if REMINDERS_ENABLED:
+            reminders.scheduler.start(bot)
+        pool.start()
+
+    @ingress.shutdown()
+    async def on_shutdown() -> None:
+        await reminders.scheduler.stop()
+        await pool.stop()
+
+    # Ingress has no handlers of its own, Telegram should send what workers handle
+    allowed_updates = dp.resolve_used_update_types()
+    if BOT_MODE == "webhook":
+        await webhook.serve(ingress, bot, allowed_updates)
+    else:
+        # Updates are forwarded one by one, so queues get them in the order Telegram sent them
+        await ingress.start_polling(bot, handle_as_tasks = False, allowed_updates = allowed_updates)
+
+def run_worker(index: int, queue) -> None:
+    "Worker process entry point"
+    logging.basicConfig(level=logging.INFO)
+    # Ctrl+C reaches the whole process group, ingress stops workers itself once polling is over
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(work(index, queue))
+
+async def work(index: int, queue, concurrency: int = WORKER_CONCURRENCY) -> None:
+    """
+    Handles updates from the queue until a None is received. Updates of different users
+    are handled concurrently, updates of one user strictly one after another.
+    """
+    from habbiton.main import dp, create_bot
+
+    bot = create_bot()
+    await dp.emit_startup(bot = bot, worker = index)
+    slots = asyncio.Semaphore(concurrency)
+    users: dict[int, asyncio.Lock] = {}
+    waiting: dict[int, int] = {}
+    tasks = set()
+
+    async def handle(user_id: int, update: dict) -> None:
+        try:
+            async with users[user_id]:
+                await dp.feed_raw_update(bot, update)
+        except Exception:
+            logger.exception(f"Worker {index} failed to handle update")
+        finally:
+            waiting[user_id] -= 1
+            if waiting[user_id] == 0:
+                del waiting[user_id], users[user_id]
+            slots.release()
+
+    try:
+        while True:
+            # Taking only as many updates as can be handled, the rest wait in the queue
+            await slots.acquire()
+            item = await asyncio.to_thread(queue.get)
+            if item is None:
+                slots.release()
+                break
+            user_id, update = item
+            users.setdefault(user_id, asyncio.Lock())
+            waiting[user_id] = waiting.get(user_id, 0) + 1
+            task = asyncio.create_task(handle(user_id, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await dp.emit_shutdown(bot = bot, worker = index)
+        await bot.session.close()
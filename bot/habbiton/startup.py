@@ -0,0 +1,50 @@
+"""
+Cold start timing. Startup is split into phases, from imports to the first request for updates,
+each is timed and all of them are logged in one line once the bot is ready, so restarts can be
+tracked. Phases are exported as metrics too.
+"""
+import json
+import logging
+from time import perf_counter
+from typing import Any
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod, GetUpdates
+
+from habbiton import STARTED
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    def __init__(self, started: float):
+        self.started = self.last = started
+        self.phases: dict[str, float] = {}
+        self.finished = False
+
+    def mark(self, phase: str) -> None:
+        "Ends the phase, it took the time since the previous one ended"
+        now = perf_counter()
+        self.phases[phase] = round(self.phases.get(phase, 0) + now - self.last, 3)
+        self.last = now
+
+    def finish(self, phase: str = None) -> None:
+        "Ends the last phase and logs all of them, only the first call counts"
+        if self.finished:
+            return
+        if phase:
+            self.mark(phase)
+        self.finished = True
+        self.phases["total"] = round(self.last - self.started, 3)
+        logger.info(f"Started in {self.phases['total']}s {json.dumps(self.phases)}")
+
+    def stats(self) -> dict:
+        return self.phases
+
+timer = StartupTimer(STARTED)
+
+class FirstPoll(BaseRequestMiddleware):
+    "Bot session middleware finishing startup timing when updates are requested for the first time"
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        if isinstance(method, GetUpdates):
+            timer.finish("first_poll")
+        return await make_request(bot, method)
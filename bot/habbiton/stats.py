@@ -0,0 +1,35 @@
+from datetime import date
+from typing import NamedTuple
+
+from habbiton.models.habit import Habit
+from habbiton.periods import PERIODS
+from habbiton.analytics import HabitStats, get_habits_stats
+
+class PeriodLeader(NamedTuple):
+    habit: Habit
+    streak: int
+
+class UserStats(NamedTuple):
+    total: int
+    # Habit with the longest streak for every period type, periods without streaks are absent
+    leaders: dict[str, PeriodLeader]
+    # Stats of every habit, in the order of the habits list
+    habits: list[HabitStats]
+
+def find_leaders(habits: list[HabitStats]) -> dict[str, PeriodLeader]:
+    "Finds a habit with the longest streak for every period type, first habit wins on equal streaks"
+    leaders = {}
+    for stats in habits:
+        period = stats.habit.period
+        if period not in PERIODS:
+            continue
+        longest = stats.streaks.longest
+        leader = leaders.get(period)
+        if longest > 0 and (leader is None or longest > leader.streak):
+            leaders[period] = PeriodLeader(stats.habit, longest)
+    return {period: leaders[period] for period in PERIODS if period in leaders}
+
+async def get_user_stats(user_id: int, today: date = None) -> UserStats:
+    "Loads all user's completions once and computes stats for all habits and period types"
+    habits = await get_habits_stats(user_id, today)
+    return UserStats(len(habits), find_leaders(habits), habits)
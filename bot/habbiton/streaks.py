@@ -0,0 +1,100 @@
+from datetime import date
+from typing import Collection, Iterable, NamedTuple
+
+from habbiton.periods import PERIODS, period_key, period_start, first_full_period, local_today
+
+class Streaks(NamedTuple):
+    current: int
+    longest: int
+
+def compute_streaks(period: str, created_date: date, completions: Iterable[date], today: date = None) -> Streaks:
+    "Calculates current and longest streak from already loaded completion dates"
+    if period not in PERIODS:
+        return Streaks(0, 0)
+    return keys_streaks(period, created_date, {period_key(period, day) for day in completions}, today)
+
+def keys_streaks(period: str, created_date: date, done: Collection[int], today: date = None) -> Streaks:
+    """
+    Calculates current and longest streak from indexes of completed periods.
+    Walks periods back from the current one, the current period is always checked and doesn't break
+    the current streak while incomplete, older periods are checked while they start on or after creation date.
+    """
+    if period not in PERIODS or created_date is None:
+        return Streaks(0, 0)
+    today = today or local_today()
+    if today < created_date:
+        return Streaks(0, 0)
+
+    now = period_key(period, today)
+    first = min(first_full_period(period, created_date), now)
+
+    current = longest = streak = 0
+    broken = False
+    for key in range(now, first - 1, -1):
+        if key in done:
+            streak += 1
+            if not broken:
+                current += 1
+        else:
+            if streak > longest:
+                longest = streak
+            streak = 0
+            if key != now:
+                broken = True
+    if streak > longest:
+        longest = streak
+    return Streaks(current, longest)
+
+class Counters(NamedTuple):
+    "Streak counters persisted on a habit, current streak is the one ending at last_period"
+    current_streak: int = 0
+    longest_streak: int = 0
+    last_period: int = None
+    total_completions: int = 0
+
+def count_completion(period: str, created_date: date, counters: Counters, day: date) -> Counters:
+    """
+    Advances counters by a new completion made on the day. A completion in the partial period
+    at creation is only remembered, like compute_streaks it doesn't count once that period is over.
+    """
+    key = period_key(period, day)
+    total = counters.total_completions + 1
+    if counters.last_period is not None and key <= counters.last_period:
+        # Period is already completed, or the completion is backdated
+        return counters._replace(total_completions = total)
+    first = first_full_period(period, created_date)
+    if key < first:
+        return counters._replace(last_period = key, total_completions = total)
+    if counters.last_period == key - 1 and key - 1 >= first:
+        current = counters.current_streak + 1
+    else:
+        current = 1
+    return Counters(current, max(counters.longest_streak, current), key, total)
+
+def rebuild_counters(period: str, created_date: date, completions: Iterable[date]) -> Counters:
+    "Calculates counters from scratch, as if all completions were counted one by one"
+    completions = list(completions)
+    if period not in PERIODS or created_date is None or not completions:
+        return Counters(total_completions = len(completions))
+    last = max(period_key(period, day) for day in completions)
+    if last < first_full_period(period, created_date):
+        return Counters(0, 0, last, len(completions))
+    streaks = compute_streaks(period, created_date, completions, period_start(period, last))
+    return Counters(streaks.current, streaks.longest, last, len(completions))
+
+def counters_streaks(period: str, created_date: date, counters: Counters, today: date = None) -> Streaks:
+    "Reads streaks from counters, a streak whose last period is over and wasn't followed by a completion is broken"
+    if period not in PERIODS or created_date is None or counters.last_period is None:
+        return Streaks(0, 0)
+    today = today or local_today()
+    if today < created_date:
+        return Streaks(0, 0)
+    now = period_key(period, today)
+    first = first_full_period(period, created_date)
+    if now < first:
+        # Still in the partial period at creation, it's the only one counted so far
+        done = int(counters.last_period == now)
+        return Streaks(done, done)
+    if counters.last_period >= max(now - 1, first):
+        return Streaks(counters.current_streak, counters.longest_streak)
+    return Streaks(0, counters.longest_streak)
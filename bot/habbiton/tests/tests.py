@@ -1,11 +1,16 @@
 import pytest
 import pytest_asyncio
-from sqlalchemy import select, delete, update
+from sqlalchemy import select, delete, update, insert, func, text
 
 from habbiton.models.habit import Habit, HabitCompletion
 from habbiton.models.state import Level, Message, Button
 from habbiton.models.user import User
+from habbiton.streaks import compute_streaks
+from habbiton.stats import get_user_stats
+from habbiton.uow import unit_of_work
+from habbiton.migrations import migrate, LATEST_VERSION
 from datetime import date, timedelta
+from itertools import islice
 pytest_plugins = ('pytest_asyncio')
 
 
@@ -304,3 +309,890 @@ async def test_monthly_streak_broken_max(db_session):
         streak = await habit.calculate_longest_streak()
 
     assert streak == 4
+
+@pytest.mark.asyncio
+async def test_streaks_single_load(db_session):
+    today = date.today()
+    async with db_session() as ses:
+        for i in range(1, 29):
+            if i in [7, 22]:
+                continue
+            ses.add(HabitCompletion(habit_id = 1001, created_date = today - timedelta(days=i)))
+        await ses.commit()
+
+    async with db_session() as ses:
+        stmt = select(Habit).where(Habit.id  == 1001)
+        habit: Habit = (await ses.execute(stmt)).scalar()
+        streaks = await habit.calculate_streaks()
+
+    assert streaks.current == 6 and streaks.longest == 14
+
+def test_streaks_weekly_partial_first_week():
+    # Habit created on Wednesday, the partial week is only counted while it's the current one
+    created = date(2024, 1, 3)
+    completions = [date(2024, 1, 3), date(2024, 1, 8)]
+    assert compute_streaks("Weekly", created, completions, date(2024, 1, 4)) == (1, 1)
+    assert compute_streaks("Weekly", created, completions, date(2024, 1, 9)) == (1, 1)
+    assert compute_streaks("Weekly", created, completions, date(2024, 1, 16)) == (1, 1)
+    assert compute_streaks("Weekly", created, completions, date(2024, 1, 23)) == (0, 1)
+
+def test_streaks_before_creation():
+    assert compute_streaks("Daily", date(2024, 1, 3), [date(2024, 1, 3)], date(2024, 1, 2)) == (0, 0)
+
+def test_period_calendar():
+    from datetime import datetime, timezone
+    from habbiton.periods import PeriodCalendar, period_key
+    now = datetime(2025, 3, 31, 23, 30, tzinfo = timezone.utc)
+    assert PeriodCalendar().today(now) == date(2025, 3, 31)
+    tokyo = PeriodCalendar("Asia/Tokyo")
+    assert tokyo.today(now) == date(2025, 4, 1)
+    assert tokyo.key("Monthly", tokyo.today(now)) == period_key("Monthly", date(2025, 3, 31)) + 1
+
+@pytest.mark.asyncio
+async def test_completion_period_keys(db_session):
+    from habbiton.periods import period_key
+    start = date(2024, 1, 1)
+    async with db_session() as ses:
+        ses.add(Habit(id = 1002, user_id = 123, name = 'Test2', period = "Weekly", created_date = start))
+        ses.add(Habit(id = 1003, user_id = 123, name = 'Test3', period = "Monthly", created_date = start))
+        await ses.commit()
+        # Inserted without keys, the trigger fills them in
+        days = [start + timedelta(days = i) for i in range(0, 400, 32)]
+        await ses.execute(insert(HabitCompletion), [{"habit_id": id, "created_date": day} for id in (1001, 1002, 1003) for day in days])
+        await ses.commit()
+        stmt = select(Habit.period, HabitCompletion.created_date, HabitCompletion.period_key).join(Habit, Habit.id == HabitCompletion.habit_id)
+        rows = (await ses.execute(stmt)).all()
+    assert len(rows) == 3 * len(days)
+    assert all(key == period_key(period, day) for period, day, key in rows)
+
+    await Habit.rebuild_counters(user_ids = [123])
+    monday = date(2025, 3, 3)
+    habit = await Habit.get_user_habit(123, 1002)
+    await habit.complete(monday)
+    await habit.complete(monday + timedelta(days = 2))
+    assert await habit.check_completion(monday + timedelta(days = 6))
+    assert not await habit.check_completion(monday + timedelta(days = 7))
+    assert habit.total_completions == len(days) + 1
+    assert len(await habit.get_completion_keys()) == len(days) + 1
+
+@pytest.mark.asyncio
+async def test_habits_pagination(db_session):
+    today = date.today()
+    async with db_session() as ses:
+        for id in range(1002, 1010):
+            ses.add(Habit(id = id, user_id = 123, name = f'Test{id}', period = "Daily", starred = id % 3 == 0, created_date = date(2024, 1, 1)))
+        await ses.commit()
+        ses.add(HabitCompletion(habit_id = 1005, created_date = today))
+        await ses.commit()
+    expected = [1002, 1005, 1008, 1001, 1003, 1004, 1006, 1007, 1009]
+
+    pages, cursor = [], None
+    while True:
+        page = await Habit.get_user_habits_page(123, "Daily", cursor, limit = 4)
+        pages.append([habit.id for habit, _ in page.habits])
+        assert dict((habit.id, completed) for habit, completed in page.habits).get(1005, True)
+        if page.next is None:
+            break
+        cursor = page.next
+    assert pages == [expected[:4], expected[4:8], expected[8:]]
+    assert page.previous is not None
+
+    page = await Habit.get_user_habits_page(123, "Daily", page.previous, limit = 4)
+    assert [habit.id for habit, _ in page.habits] == expected[4:8] and page.next is not None
+    page = await Habit.get_user_habits_page(123, "Daily", page.previous, limit = 4)
+    assert [habit.id for habit, _ in page.habits] == expected[:4] and page.previous is None
+
+    # Cursor past deleted habits starts from the first page
+    habit = await Habit.get_user_habit(123, 1009)
+    await habit.delete()
+    page = await Habit.get_user_habits_page(123, "Daily", cursor, limit = 4)
+    assert [habit.id for habit, _ in page.habits] == expected[:4]
+    assert await Habit.count_user_habits(123, "Daily") == 8
+
+@pytest.mark.asyncio
+async def test_user_stats(db_session):
+    today = date.today()
+    async with db_session() as ses:
+        ses.add(Habit(id = 1002, user_id = 123, name = 'Test2', period = "Daily", created_date = date(year = 2024, month = 1, day = 1)))
+        ses.add(Habit(id = 1003, user_id = 123, name = 'Test3', period = "Weekly", created_date = date(year = 2024, month = 1, day = 1)))
+        await ses.commit()
+        for i in range(1, 4):
+            ses.add(HabitCompletion(habit_id = 1001, created_date = today - timedelta(days=i)))
+        for i in range(1, 6):
+            ses.add(HabitCompletion(habit_id = 1002, created_date = today - timedelta(days=i)))
+        await ses.commit()
+
+    stats = await get_user_stats(123)
+    assert stats.total == 3
+    assert list(stats.leaders) == ["Daily"]
+    assert stats.leaders["Daily"].habit.id == 1002 and stats.leaders["Daily"].streak == 5
+    assert [habit_stats.habit.id for habit_stats in stats.habits] == [1001, 1002, 1003]
+    # Today isn't completed yet, so it's not counted
+    assert stats.habits[1].completions == 5 and stats.habits[1].consistency == 5 / 27
+    assert stats.habits[0].streaks == (3, 3) and stats.habits[2].streaks == (0, 0) and stats.habits[2].best_weekday is None
+
+def test_analytics():
+    from habbiton.analytics import habit_stats
+    today = date(2025, 3, 12)
+    habit = Habit(name = 'Test', period = "Daily", created_date = date(2025, 1, 1))
+    days = [(today - timedelta(days = i)).toordinal() for i in range(28, 0, -1)]
+    stats = habit_stats(habit, days, today)
+    assert stats.rate == 28 / 70 and stats.consistency == 1
+    # One completion in the 4 weeks before
+    assert stats.trend == 1 - 1 / 28
+    assert stats.streaks == (28, 28) and stats.best_weekday == 0
+
+@pytest.mark.parametrize("period", ["Daily", "Weekly", "Monthly"])
+def test_analytics_fallback(period, monkeypatch):
+    import random
+    from habbiton import analytics
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(period)
+    today = date(2025, 3, 12)
+    for _ in range(30):
+        created_date = today - timedelta(days = rng.randint(0, 700))
+        habit = Habit(name = 'Test', period = period, created_date = created_date)
+        days = range(created_date.toordinal(), today.toordinal() + 1)
+        days = sorted(rng.sample(days, rng.randint(0, len(days))))
+        streaks = compute_streaks(period, created_date, map(date.fromordinal, days), today)
+
+        monkeypatch.setattr(analytics, "numpy", None)
+        expected = analytics.habit_stats(habit, days, today)
+        monkeypatch.setattr(analytics, "numpy", numpy)
+        assert analytics.habit_stats(habit, numpy.array(days, dtype = numpy.int64), today) == expected
+        assert expected.streaks == streaks
+
+@pytest.mark.asyncio
+async def test_state_graph(db_session):
+    async with db_session() as ses:
+        ses.add(Level(name = "stats", callback = "show_stats"))
+        await ses.commit()
+        ses.add(Message(level_name = "main", text = "Second", order = 2))
+        ses.add(Message(level_name = "main", text = "First", order = 1))
+        ses.add(Button(current_level_name = "main", target_level_name = "stats", text = "Stats", order = 1))
+        await ses.commit()
+
+    graph = await Level.get_graph()
+    assert graph.level("main").messages == ("First", "Second")
+    assert graph.level("main").keyboard.keyboard[0][0].text == "Stats"
+    assert graph.level("stats").callback == "show_stats"
+    assert graph.check_button("main", "Stats").target_level_name == "stats"
+    assert graph.check_button("stats", "Stats") is None
+
+    async with db_session() as ses:
+        ses.add(Message(level_name = "stats", text = "Stats"))
+        await ses.commit()
+    assert (await Level.get_graph()).level("stats").messages == ()
+    from habbiton import cache
+    await cache.backend.invalidate(cache.LEVELS_KEY)
+    assert (await Level.get_graph()).level("stats").messages == ("Stats",)
+
+@pytest.mark.asyncio
+async def test_user_store_write_behind(db_session):
+    User.store.start()
+    try:
+        user = await User.from_id(123)
+        assert (await User.from_id(123)) is user
+
+        await user.update(current_level = "main", latest_msg_id = 1)
+        await user.update(latest_msg_id = 2)
+        async with db_session() as ses:
+            assert (await ses.execute(select(User.latest_msg_id).where(User.id == 123))).scalar() is None
+
+        await user.update(latest_msg_id = 3, flush = True)
+        async with db_session() as ses:
+            assert (await ses.execute(select(User.latest_msg_id).where(User.id == 123))).scalar() == 3
+        assert User.store.dirty == {}
+    finally:
+        await User.store.stop()
+        User.store.clear()
+
+@pytest.mark.asyncio
+async def test_unit_of_work(db_session):
+    with pytest.raises(RuntimeError):
+        async with unit_of_work(db_session):
+            await Habit.new("Test2", 123)
+            await Habit.set_period("Daily", 123)
+            raise RuntimeError
+    assert len(await Habit.get_user_habits(123)) == 1
+
+    async with unit_of_work(db_session) as ses:
+        await Habit.new("Test2", 123)
+        assert len(await Habit.get_user_habits(123)) == 2
+        async with unit_of_work() as nested:
+            assert nested is ses
+    assert len(await Habit.get_user_habits(123)) == 2
+
+@pytest.mark.asyncio
+async def test_migrations_upgrade_in_place(db_session):
+    today = date.today()
+    monday = today - timedelta(today.weekday())
+    async with db_session() as ses:
+        # Schema of a deployment from before the indexes and period keys
+        await ses.execute(text("DROP INDEX uq_habit_completions_habit_period"))
+        await ses.execute(text("DROP INDEX ix_habits_user_period_starred"))
+        await ses.execute(text("DROP TRIGGER habit_completions_period_key ON habit_completions"))
+        await ses.execute(text("ALTER TABLE habit_completions DROP COLUMN period_key"))
+        await ses.execute(text("ALTER TABLE users DROP COLUMN timezone"))
+        ses.add(Habit(id = 1002, user_id = 123, name = 'Test2', period = "Weekly", created_date = date(2024, 1, 1)))
+        await ses.commit()
+        stmt = text("INSERT INTO habit_completions (habit_id, created_date) VALUES (:habit_id, :created_date)")
+        await ses.execute(stmt, [{"habit_id": 1001, "created_date": today}] * 3)
+        await ses.execute(stmt, [{"habit_id": 1002, "created_date": day} for day in (today, monday)])
+        await ses.commit()
+
+    async with db_session() as ses:
+        assert await migrate(await ses.connection()) == LATEST_VERSION
+        await ses.commit()
+        assert await migrate(await ses.connection()) == LATEST_VERSION
+        await ses.commit()
+
+    async with db_session() as ses:
+        stmt = select(HabitCompletion.habit_id, HabitCompletion.created_date, HabitCompletion.period_key).order_by(HabitCompletion.habit_id)
+        # One completion per period is left, the earliest one
+        assert (await ses.execute(stmt)).all() == [(1001, today, today.toordinal()), (1002, monday, (monday.toordinal() - 1) // 7)]
+
+    habit = await Habit.get_user_habit(123, 1001)
+    # Counters are backfilled from the remaining completion
+    assert habit.total_completions == 1 and habit.completed_in_current_period()
+    await habit.complete()
+    async with db_session() as ses:
+        stmt = select(func.count()).select_from(HabitCompletion)
+        assert (await ses.execute(stmt)).scalar() == 2
+
+@pytest.mark.asyncio
+@pytest.mark.commits
+async def test_startup_fast_path(db_session, db_engine):
+    import asyncio
+    from sqlalchemy import event
+    from habbiton import startup
+    from habbiton.models.schema import SchemaVersion
+    from habbiton.utils import fill_new_db, db_is_current, SEED_VERSION
+    # Test schema is made by create_all, versions were never written
+    assert not await db_is_current(db_engine)
+    await fill_new_db(db_engine)
+    assert await db_is_current(db_engine)
+
+    statements = []
+    def count(*args):
+        statements.append(args[2])
+    event.listen(db_engine.sync_engine, "before_cursor_execute", count)
+    try:
+        await fill_new_db(db_engine)
+    finally:
+        event.remove(db_engine.sync_engine, "before_cursor_execute", count)
+    assert len(statements) == 1 and "schema_version" in statements[0]
+    assert "db_connect" in startup.timer.phases and "schema" in startup.timer.phases
+
+    # Instances starting at once against an unseeded db seed it once
+    async with db_session() as ses:
+        await ses.execute(text("TRUNCATE levels CASCADE"))
+        await ses.execute(update(SchemaVersion).values(seed_version = 0))
+        await ses.commit()
+    await asyncio.gather(*(fill_new_db(db_engine) for _ in range(3)))
+    async with db_session() as ses:
+        assert (await ses.execute(select(func.count()).select_from(Level))).scalar() == 7
+        assert (await ses.execute(select(SchemaVersion.version, SchemaVersion.seed_version))).one() == (LATEST_VERSION, SEED_VERSION)
+
+@pytest.mark.asyncio
+async def test_streak_counters(db_session):
+    habit = await Habit.get_user_habit(123, 1001)
+    start = date(2024, 3, 1)
+    for offset in (0, 1, 2, 4, 5, 5):
+        await habit.complete(start + timedelta(offset))
+    assert habit.total_completions == 5
+
+    completions = await habit.get_completion_dates()
+    for offset in range(5, 9):
+        today = start + timedelta(offset)
+        assert habit.streaks(today) == compute_streaks(habit.period, habit.created_date, completions, today)
+
+    # Counters survive reloading and match the ones rebuilt from completions
+    habit = await Habit.get_user_habit(123, 1001)
+    assert habit.streaks(start + timedelta(6)) == (2, 3)
+    assert await Habit.rebuild_counters(verify = True) == []
+
+    async with db_session() as ses:
+        await ses.execute(update(Habit).where(Habit.id == 1001).values(longest_streak = 0))
+        await ses.commit()
+    assert await Habit.rebuild_counters(verify = True) == [1001]
+    assert await Habit.rebuild_counters() == [1001]
+    assert await Habit.rebuild_counters(verify = True) == []
+
+@pytest.mark.asyncio
+@pytest.mark.commits
+@pytest.mark.parametrize("format", ["csv", "ndjson"])
+async def test_history_export_import(db_session, tmp_path, format):
+    from habbiton import cache
+    from habbiton.history import export_history, import_history
+    bind = db_session.kw["bind"]
+    start = date(2024, 1, 1)
+    async with db_session() as ses:
+        await ses.execute(update(User).where(User.id == 123).values(username = 'Quote "me", maybe'))
+        ses.add(User(id = 124))
+        await ses.commit()
+        ses.add(Habit(id = 1002, user_id = 124, name = 'Other', period = "Weekly", created_date = start))
+        await ses.commit()
+        await ses.execute(insert(HabitCompletion), [{"habit_id": 1001, "created_date": start + timedelta(i)} for i in range(30)])
+        await ses.execute(insert(HabitCompletion), [{"habit_id": 1002, "created_date": start}])
+        await ses.commit()
+
+    counts = await export_history(tmp_path, [123], format, chunk_size = 7, bind = bind)
+    assert counts == {"users": 1, "habits": 1, "habit_completions": 30}
+
+    async with db_session() as ses:
+        await ses.execute(delete(HabitCompletion).where(HabitCompletion.habit_id == 1001))
+        await ses.execute(delete(Habit).where(Habit.id == 1001))
+        await ses.commit()
+
+    # Counters of habits that aren't in the files are left as they are
+    async with db_session() as ses:
+        await ses.execute(update(Habit).where(Habit.id == 1002).values(total_completions = 5))
+        await ses.commit()
+    invalidated = []
+    cache.subscribe(invalidated.append)
+    try:
+        counts = await import_history(tmp_path, chunk_size = 7, bind = bind)
+    finally:
+        cache.subscribers.remove(invalidated.append)
+    # The user is still there, so only their habits come back
+    assert counts == {"users": 0, "habits": 1, "habit_completions": 30}
+    assert invalidated == ["habit:1001", "habits:123"]
+    assert (await Habit.get_user_habit(124, 1002)).total_completions == 5
+    habit = await Habit.get_user_habit(123, 1001)
+    assert habit.name == 'Test' and habit.created_date == start and habit.starred is False
+    assert habit.total_completions == 30 and habit.longest_streak == 30
+    assert len(await habit.get_completion_dates()) == 30
+
+    # Sequences continue after imported ids
+    await Habit.new("New", 123)
+    assert max(habit.id for habit in await Habit.get_user_habits(123)) > 1002
+
+    async with db_session() as ses:
+        await ses.execute(delete(HabitCompletion))
+        await ses.execute(delete(Habit))
+        await ses.execute(delete(User).where(User.id == 123))
+        await ses.commit()
+    counts = await import_history(tmp_path, bind = bind)
+    assert counts == {"users": 1, "habits": 1, "habit_completions": 30}
+    assert (await User.from_id(123)).username == 'Quote "me", maybe'
+
+@pytest.mark.asyncio
+@pytest.mark.commits
+@pytest.mark.parametrize("format", ["csv", "ndjson"])
+async def test_history_import_before_period_keys(db_session, tmp_path, format):
+    import csv, gzip, json
+    from habbiton.history import export_history, import_history, table_path
+    bind = db_session.kw["bind"]
+    start = date(2024, 1, 1)
+    async with db_session() as ses:
+        await ses.execute(insert(HabitCompletion), [{"habit_id": 1001, "created_date": start + timedelta(i)} for i in range(3)])
+        await ses.commit()
+    await export_history(tmp_path, [123], format, bind = bind)
+
+    # Exports made before users had time zones and completions had period keys
+    for table, column in ((User.__table__, "timezone"), (HabitCompletion.__table__, "period_key")):
+        path = table_path(tmp_path, table, format)
+        with gzip.open(path, "rt", newline = "") as file:
+            if format == "csv":
+                rows = list(csv.reader(file))
+                index = rows[0].index(column)
+                lines = [row[:index] + row[index + 1:] for row in rows]
+            else:
+                lines = [{key: value for key, value in json.loads(line).items() if key != column} for line in file]
+        with gzip.open(path, "wt", newline = "") as file:
+            if format == "csv":
+                csv.writer(file).writerows(lines)
+            else:
+                file.writelines(json.dumps(line) + "\n" for line in lines)
+
+    async with db_session() as ses:
+        await ses.execute(delete(HabitCompletion))
+        await ses.execute(delete(Habit))
+        await ses.execute(delete(User))
+        await ses.commit()
+    counts = await import_history(tmp_path, bind = bind)
+    assert counts == {"users": 1, "habits": 1, "habit_completions": 3}
+    # Defaults and the trigger fill what the files lack
+    assert (await User.from_id(123)).timezone is None
+    habit = await Habit.get_user_habit(123, 1001)
+    assert sorted(await habit.get_completion_keys()) == [start.toordinal() + i for i in range(3)]
+    assert habit.total_completions == 3 and habit.longest_streak == 3
+
+async def add_menu_levels(db_session):
+    "Adds levels and buttons used to browse habits and stats from the main menu"
+    async with db_session() as ses:
+        for name in ("start", "my_habits", "my_stats"):
+            ses.add(Level(name = name))
+        await ses.commit()
+        ses.add(Message(level_name = "main", text = "Main menu"))
+        ses.add(Button(current_level_name = "main", target_level_name = "my_habits", text = "My habits", callback = "show_habits", order = 1))
+        ses.add(Button(current_level_name = "main", target_level_name = "my_stats", text = "My stats", callback = "show_stats", order = 2))
+        ses.add(Button(current_level_name = "my_habits", target_level_name = "main", text = "Back", callback = "purge_msg", order = 1))
+        ses.add(Button(current_level_name = "my_stats", target_level_name = "main", text = "Back", order = 1))
+        await ses.commit()
+
+@pytest.mark.asyncio
+@pytest.mark.commits
+async def test_benchmark(db_session, monkeypatch):
+    from habbiton import main, metrics
+    from habbiton.bench import run_benchmark, compare
+    await add_menu_levels(db_session)
+    monkeypatch.setattr(main, "METRICS_PORT", 9999)
+
+    results = await run_benchmark(users = 3, habits = 6, years = 1, rounds = 2, concurrency = 2, global_rate = 1000, chat_rate = 1000, bind = db_session.kw["bind"])
+    # Requests went through the outbound scheduler, metrics weren't served without asking
+    assert metrics.registry.sources["outbound"]()["sent"] > 0
+    assert metrics.server.runner is None
+    assert results["total"]["count"] == 3 * (1 + 2 * 7)
+    assert set(results["kinds"]) == {"start", "my_habits", "info", "complete", "filter", "back", "my_stats"}
+    assert results["kinds"]["my_habits"]["queries_per_update"] > 0
+    assert results["kinds"]["info"]["api_calls_per_update"] == 1
+    assert results["total"]["p50_ms"] <= results["total"]["p99_ms"]
+
+    habits = await Habit.get_user_habits(1_000_000_000)
+    assert len(habits) == 6 and sum(habit.total_completions for habit in habits) > 0
+    assert await Habit.rebuild_counters(verify = True) == []
+    assert "total" in compare(results, results)
+
+@pytest.mark.asyncio
+async def test_update_metrics(db_session, db_engine, monkeypatch, caplog):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from habbiton import metrics
+    from habbiton.bench import FakeSession, scenario
+    from habbiton.main import dp
+    await add_menu_levels(db_session)
+    metrics.instrument_engine(db_engine)
+    metrics.registry.clear()
+    monkeypatch.setattr(metrics, "SLOW_UPDATE_SECONDS", 0)
+
+    bot = Bot("42:TEST", session = FakeSession(latency = 0.01))
+    bot.session.middleware(metrics.ApiTimer())
+    updates = dict(islice(scenario(123, [1001], 1), 3))
+    for update_id, kind in enumerate(("my_habits", "info")):
+        await dp.feed_update(bot, Update.model_validate({"update_id": update_id, **updates[kind]}, context = {"bot": bot}))
+
+    totals = metrics.registry.updates[("respond", "show_habits")]
+    assert totals["count"] == 1 and totals["queries"] > 0 and totals["db_seconds"] > 0
+    totals = metrics.registry.updates[("respond_inline", "info")]
+    assert totals["api_calls"] == 1 and totals["api_seconds"] >= 0.01
+    text = metrics.registry.render()
+    assert 'habbiton_updates_total{handler="respond_inline",callback="info"} 1' in text
+    assert 'habbiton_update_seconds_bucket{handler="respond",callback="show_habits",le="+Inf"} 1' in text
+    assert "habbiton_slow_updates_total 2" in text
+    assert "Slow update" in caplog.text
+
+@pytest.mark.asyncio
+async def test_user_middleware(db_session):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from sqlalchemy import event
+    from habbiton.bench import FakeSession, Sample, current, scenario
+    from habbiton.main import dp
+    await add_menu_levels(db_session)
+    bind = db_session.kw["bind"]
+    statements = []
+    def record(conn, cursor, statement, *args):
+        # Savepoints come from the test's transaction
+        if not statement.startswith(("SAVEPOINT", "RELEASE")):
+            statements.append(statement)
+    event.listen(bind.sync_engine, "before_cursor_execute", record)
+    try:
+        # Unknown user is registered by any message and welcomed instead of handling it
+        bot = Bot("42:TEST", session = FakeSession())
+        sample = Sample()
+        token = current.set(sample)
+        updates = dict(islice(scenario(124, [1001], 1), 2))
+        await dp.feed_update(bot, Update.model_validate({"update_id": 1, **updates["my_habits"]}, context = {"bot": bot}))
+        current.reset(token)
+        assert sample.api_calls == 1
+        user = await User.from_id(124)
+        assert user.username == "bench124" and user.current_level == "main"
+
+        # Cached once the registration was committed
+        statements.clear()
+        user, registered = await User.resolve(124, "bench124")
+        assert user.id == 124 and not registered and statements == []
+        # Users missing from cache are read by the same upsert, renames are saved
+        user, registered = await User.resolve(123, "renamed")
+        assert not registered and user.username == "renamed" and len(statements) == 1
+    finally:
+        event.remove(bind.sync_engine, "before_cursor_execute", record)
+    assert (await User.from_id(123)).username == "renamed"
+
+def test_callback_routes():
+    from habbiton.routes import routes
+    import habbiton.handler
+    route, args = routes.unpack(routes.pack("show_habits", True, "Weekly"))
+    assert route.name == "show_habits" and args == [True, "Weekly"]
+    assert routes.unpack(routes.pack("show_habits", True, None))[1] == [True]
+    assert routes.unpack(routes.pack("show_habits", True, None, (True, 1001, False)))[1] == [True, None, (True, 1001, False)]
+    assert routes.unpack("show_habits|y||n,1001,y")[1] == [True, None, (False, 1001, True)]
+    assert routes.unpack(routes.pack("info", 2**31 - 1))[1] == [2**31 - 1]
+    assert len(routes.pack("info", 2**31 - 1)) < len(f"info|{2**31 - 1}")
+    # Buttons sent before the compact format keep working
+    assert routes.unpack("info|1001")[1] == [1001]
+    assert routes.unpack("show_habits|y|Daily")[1] == [True, "Daily"]
+    for data in ("move_user|main", "purge_msg", "__init__", "info", "info|x", "info|1|2", "show_habits|y|Yearly", "!", "!_w", "!AoA"):
+        assert routes.unpack(data) is None
+
+@pytest.mark.asyncio
+async def test_unknown_callback_rejected(db_session):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from habbiton.bench import FakeSession
+    from habbiton.main import dp
+    bot = Bot("42:TEST", session = FakeSession())
+    user = {"id": 123, "is_bot": False, "first_name": "Test"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": 123, "type": "private"}, "text": "Total"}
+    for id, data in enumerate(("move_user|new_habit", "set_reminder|00:00")):
+        update = {"update_id": id, "callback_query": {"id": str(id), "from": user, "chat_instance": "1", "data": data, "message": message}}
+        await dp.feed_update(bot, Update.model_validate(update, context = {"bot": bot}))
+    user = await User.from_id(123)
+    assert user.current_level == "main" and user.reminder_minute is None
+
+@pytest.mark.asyncio
+async def test_render_cache(db_session):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from habbiton import render
+    from habbiton.bench import FakeSession, scenario
+    from habbiton.main import dp
+    from habbiton.routes import routes
+    class RecordingSession(FakeSession):
+        async def make_request(self, bot, method, timeout = None):
+            methods.append(type(method).__name__)
+            return await super().make_request(bot, method, timeout)
+    methods = []
+    bot = Bot("42:TEST", session = RecordingSession())
+    info = dict(scenario(123, [1001], 1))["info"]
+    key = ("info", 1001, date.today())
+
+    await dp.feed_update(bot, Update.model_validate({"update_id": 1, **info}, context = {"bot": bot}))
+    assert methods == ["EditMessageText"]
+    text, reply_markup = render.cache.users[123].renders[key]
+    async def fail():
+        raise AssertionError("Rendered again")
+    assert await render.cache.get(123, key, fail) == (text, reply_markup)
+
+    # Pressing a button of the message already showing the same doesn't edit it
+    methods.clear()
+    info["callback_query"]["message"].update(text = text, reply_markup = reply_markup.model_dump())
+    await dp.feed_update(bot, Update.model_validate({"update_id": 2, **info}, context = {"bot": bot}))
+    assert methods == ["AnswerCallbackQuery"]
+
+    habit = await Habit.get_user_habit(123, 1001)
+    await habit.complete()
+    assert key not in render.cache.users[123].renders
+    await habit.star()
+    methods.clear()
+    await dp.feed_update(bot, Update.model_validate({"update_id": 3, **info}, context = {"bot": bot}))
+    assert methods == ["EditMessageText"]
+    text, reply_markup = render.cache.users[123].renders[key]
+    assert reply_markup.inline_keyboard[0][0].text == "Unstar"
+
+    # Renders of one user are bounded, the least recently used go first
+    cache = render.RenderCache(size = 10, user_size = 2)
+    async def rendered():
+        return "text"
+    for day in range(3):
+        await cache.get(123, ("stats", day), rendered)
+        await cache.get(123, ("info", 1001, 0), rendered)
+    assert list(cache.users[123].renders) == [("stats", 2), ("info", 1001, 0)]
+
+@pytest.mark.asyncio
+async def test_cache_backend(db_session):
+    import asyncio
+    from habbiton import cache
+    backend = cache.MemoryCache(size = 2, ttl = 60)
+    await backend.set("a", "1")
+    await backend.set("b", "2", ttl = 0.01)
+    await asyncio.sleep(0.02)
+    assert await backend.get("a") == "1" and await backend.get("b") is None
+    await backend.set("c", "3")
+    await backend.set("d", "4")
+    assert await backend.get("a") is None and await backend.get("d") == "4"
+
+    invalidated = []
+    cache.subscribe(invalidated.append)
+    try:
+        habit = await Habit.get_user_habit(123, 1001)
+        async with db_session() as ses:
+            await ses.execute(update(Habit).where(Habit.id == 1001).values(name = "Changed"))
+            await ses.commit()
+        # Read from cache, so the change behind its back isn't seen
+        cached = await Habit.get_user_habit(123, 1001)
+        assert cached.name == "Test" and cached.created_date == date(2024, 1, 1)
+        assert await Habit.get_user_habit(124, 1001) is None
+
+        await cached.star()
+        assert invalidated == ["habit:1001", "habits:123"] * 2
+        assert (await Habit.get_user_habit(123, 1001)).name == "Changed"
+
+        user = await User.from_id(123)
+        await user.update(current_level = "main")
+        assert invalidated[-1] == "user:123"
+        assert (await cache.get_row(User, cache.user_key(123))) is None
+    finally:
+        cache.subscribers.remove(invalidated.append)
+
+@pytest.mark.asyncio
+async def test_redis_cache_invalidation():
+    fakeredis = pytest.importorskip("fakeredis")
+    import asyncio
+    from habbiton import cache
+    server = fakeredis.FakeServer()
+    first = cache.RedisCache(client = fakeredis.FakeAsyncRedis(server = server))
+    second = cache.RedisCache(client = fakeredis.FakeAsyncRedis(server = server))
+    invalidated = []
+    cache.subscribe(invalidated.append)
+    try:
+        await first.start()
+        await second.start()
+        await first.set("user:1", "{}")
+        assert await second.get("user:1") == "{}"
+        await second.invalidate("user:1")
+        assert await first.get("user:1") is None
+        for _ in range(100):
+            if len(invalidated) == 2:
+                break
+            await asyncio.sleep(0.01)
+        # Once by the publishing instance itself, once by the other one from the channel
+        assert invalidated == ["user:1", "user:1"]
+    finally:
+        cache.subscribers.remove(invalidated.append)
+        await first.stop()
+        await second.stop()
+
+@pytest.mark.asyncio
+async def test_webhook(db_session):
+    from aiohttp.test_utils import TestServer, TestClient
+    from aiogram import Bot
+    from habbiton.main import dp
+    from habbiton.webhook import create_app
+
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 123, "type": "private"},
+            "from": {"id": 123, "is_bot": False, "first_name": "Test"},
+            "text": "Stats"
+        }
+    }
+    async with db_session() as ses:
+        ses.add(Level(name = "stats"))
+        await ses.commit()
+        ses.add(Button(current_level_name = "main", target_level_name = "stats", text = "Stats", order = 1))
+        await ses.commit()
+
+    bot = Bot(token = "42:TEST")
+    app = create_app(dp, bot, path = "/webhook", secret_token = "secret", handle_in_background = False)
+    async with TestClient(TestServer(app)) as client:
+        assert (await client.get("/health")).status == 200
+
+        response = await client.post("/webhook", json = update, headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert response.status == 401
+
+        response = await client.post("/webhook", json = update, headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"})
+        assert response.status == 200
+
+    async with db_session() as ses:
+        assert (await ses.execute(select(User.current_level).where(User.id == 123))).scalar() == "stats"
+
+@pytest.mark.asyncio
+async def test_webhook_shutdown():
+    import asyncio
+    from aiohttp.test_utils import TestServer, TestClient
+    from aiogram import Bot, Dispatcher
+    from habbiton.webhook import create_app
+
+    handled, cancelled = [], []
+    dp = Dispatcher()
+    @dp.message()
+    async def slow(message):
+        try:
+            await asyncio.sleep(0.1 if message.text == "slow" else 10)
+            handled.append(message.text)
+        except asyncio.CancelledError:
+            cancelled.append(message.text)
+            raise
+
+    bot = Bot(token = "42:TEST")
+    app = create_app(dp, bot, path = "/webhook", secret_token = "secret", shutdown_timeout = 0.5)
+    async with TestClient(TestServer(app)) as client:
+        for id, text in enumerate(("slow", "stuck")):
+            update = {
+                "update_id": id,
+                "message": {"message_id": id, "date": 0, "chat": {"id": 123, "type": "private"}, "text": text}
+            }
+            response = await client.post("/webhook", json = update, headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"})
+            assert response.status == 200
+        response = await client.post("/webhook", json = update, headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert response.status == 401
+        assert handled == []
+    # Responses came right away, shutting down waited for the first update and gave up on the second
+    assert handled == ["slow"] and cancelled == ["stuck"]
+    await bot.session.close()
+
+@pytest.mark.asyncio
+async def test_outbound_scheduler():
+    import asyncio
+    from aiogram.exceptions import TelegramRetryAfter
+    from aiogram.methods import SendMessage
+    from habbiton import outbound
+
+    scheduler = outbound.OutboundScheduler(global_rate = 1000, chat_rate = 1000, chat_burst = 1000)
+    sent = []
+    limited = []
+
+    async def make_request(bot, method):
+        if method.chat_id == 2 and not limited:
+            limited.append(method)
+            raise TelegramRetryAfter(method, "Flood control exceeded", 0)
+        sent.append((method.chat_id, method.text))
+        return len(sent)
+
+    with outbound.mergeable():
+        merged = await asyncio.gather(*[
+            scheduler(make_request, None, SendMessage(chat_id = 1, text = text)) for text in ("a", "b")
+        ])
+    results = await asyncio.gather(
+        scheduler(make_request, None, SendMessage(chat_id = 2, text = "c")),
+        scheduler(make_request, None, SendMessage(chat_id = 2, text = "d")),
+    )
+
+    assert merged == [1, 1]
+    assert sent == [(1, "a\n\nb"), (2, "c"), (2, "d")]
+    assert results == [2, 3]
+    assert scheduler.stats()["retries"] == 1 and scheduler.stats()["queue_depth"] == 0
+    assert scheduler.stats()["global_pauses"] == 0
+
+    # 429s of several chats at once mean the bot-wide limit, other chats wait too
+    from time import monotonic
+    flooded, times = set(), {}
+    async def flood_request(bot, method):
+        if method.chat_id in (1, 2) and method.chat_id not in flooded:
+            flooded.add(method.chat_id)
+            raise TelegramRetryAfter(method, "Flood control exceeded", 1)
+        times[method.chat_id] = monotonic()
+        return True
+    async def later(chat_id):
+        await asyncio.sleep(0.05)
+        return await scheduler(flood_request, None, SendMessage(chat_id = chat_id, text = "later"))
+    start = monotonic()
+    await asyncio.gather(*[scheduler(flood_request, None, SendMessage(chat_id = id, text = "e")) for id in (1, 2)], later(3))
+    assert scheduler.stats()["global_pauses"] == 1
+    assert times[3] - start >= 0.9
+
+@pytest.mark.asyncio
+async def test_release_failure(db_session):
+    import asyncio
+    from habbiton import uow
+
+    async def failing_commit():
+        await asyncio.sleep(0)
+        raise RuntimeError("Commit failed")
+
+    with pytest.raises(RuntimeError, match = "Commit failed"):
+        async with uow.unit_of_work(db_session) as ses:
+            ses.commit = failing_commit
+            await Habit.new("Lost", 123)
+            # Another task of the update, e.g. a send, waits for the same commit and gets its error
+            waiter = asyncio.create_task(uow.release())
+            await asyncio.sleep(0)
+            with pytest.raises(RuntimeError, match = "Commit failed"):
+                await uow.release()
+            with pytest.raises(RuntimeError, match = "Commit failed"):
+                await waiter
+            # Model calls don't fall back to sessions of their own
+            with pytest.raises(RuntimeError, match = "failed to commit"):
+                await Habit.count_user_habits(123)
+            await uow.release()
+    assert await Habit.count_user_habits(123) == 1
+
+@pytest.mark.asyncio
+@pytest.mark.commits
+async def test_outbound_after_commit(db_session, db_engine):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from habbiton import outbound
+    from habbiton.bench import FakeSession, scenario
+    from habbiton.main import dp
+    await add_menu_levels(db_session)
+    async with db_session() as ses:
+        ses.add(Message(level_name = "main", text = "Pick an option"))
+        await ses.commit()
+
+    class CheckingSession(FakeSession):
+        "Records what every request saw in db at the moment it was sent"
+        def __init__(self):
+            super().__init__()
+            self.sent = []
+
+        async def make_request(self, bot, method, timeout = None):
+            checked_out = db_engine.pool.checkedout()
+            async with db_engine.connect() as conn:
+                level = (await conn.execute(select(User.current_level).where(User.id == 123))).scalar()
+            self.sent.append((type(method).__name__, getattr(method, "text", None), checked_out, level))
+            return await super().make_request(bot, method, timeout)
+
+    bot = Bot("42:TEST", session = CheckingSession())
+    bot.session.middleware(outbound.OutboundScheduler(global_rate = 1000, chat_rate = 1000, chat_burst = 1000))
+    updates = dict(scenario(123, [1001], 1))
+    for update_id, kind in enumerate(("start", "complete")):
+        await dp.feed_update(bot, Update.model_validate({"update_id": update_id, **updates[kind]}, context = {"bot": bot}))
+
+    # Level messages are merged and sent once the level change is committed and the connection is back in the pool
+    assert bot.session.sent[0] == ("SendMessage", "Main menu\n\nPick an option", 0, "main")
+    # Edit after completion waits for nothing, the habit's row lock is released
+    assert bot.session.sent[-1][0] == "EditMessageText" and bot.session.sent[-1][2] == 0
+    async with db_session() as ses:
+        assert (await ses.execute(select(func.count()).select_from(HabitCompletion))).scalar() == 1
+
+@pytest.mark.asyncio
+async def test_reminders(db_session):
+    from datetime import datetime, time
+    from habbiton.reminders import ReminderScheduler
+
+    today = date.today()
+    async with db_session() as ses:
+        await ses.execute(update(User).where(User.id == 123).values(reminder_minute = 9 * 60))
+        ses.add(Habit(id = 1002, user_id = 123, name = 'Test2', period = "Weekly", created_date = date(year = 2024, month = 1, day = 1)))
+        await ses.commit()
+        ses.add(HabitCompletion(habit_id = 1002, created_date = today))
+        await ses.commit()
+
+    sent = []
+    failing = {}
+    class FakeBot:
+        async def send_message(self, chat_id, text):
+            if chat_id in failing:
+                raise failing[chat_id]
+            sent.append((chat_id, text))
+
+    scheduler = ReminderScheduler()
+    scheduler.bot = FakeBot()
+    assert await scheduler.remind(datetime.combine(today, time(9, 1))) == 0
+    assert await scheduler.remind(datetime.combine(today, time(9, 0))) == 1
+    assert sent[0][0] == 123 and "Test (daily)" in sent[0][1] and "Test2" not in sent[0][1]
+    # Already reminded today
+    assert await scheduler.remind(datetime.combine(today, time(9, 0))) == 0
+
+    # Failed reminders don't keep the day claimed and don't stop the rest of the batch
+    from aiogram.exceptions import TelegramForbiddenError
+    from aiogram.methods import SendMessage
+    async with db_session() as ses:
+        ses.add_all([User(id = id, reminder_minute = 10 * 60) for id in (124, 125, 126)])
+        await ses.commit()
+        ses.add_all([Habit(user_id = id, name = 'Other', period = "Daily", created_date = today) for id in (124, 125, 126)])
+        await ses.commit()
+    failing[124] = TelegramForbiddenError(SendMessage(chat_id = 124, text = ""), "bot was blocked by the user")
+    failing[125] = RuntimeError("Connection lost")
+    assert await scheduler.remind(datetime.combine(today, time(10, 0))) == 1
+    assert sent[-1][0] == 126
+    failing.clear()
+    assert await scheduler.remind(datetime.combine(today, time(10, 0))) == 2
+    assert sorted(chat_id for chat_id, _ in sent[-2:]) == [124, 125]
@@ -0,0 +1,108 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from inspect import isawaitable
+from habbiton import session
+
+#Session of the unit of work opened for the update being handled, None outside of it
+current_session = ContextVar("current_session", default = None)
+#Factory used by units of work, can be replaced the same way as models' sessions
+default_session = session
+
+def set_session(session) -> None:
+    global default_session
+    default_session = session
+
+def active_session():
+    "Session of the current unit of work, None outside of it or once it's released, raises if releasing it failed"
+    ses = current_session.get()
+    if ses is None:
+        return None
+    released = ses.info.get("released")
+    if released is None:
+        return ses
+    if released.done() and (released.cancelled() or released.exception() is not None):
+        # Changes of the update are lost, model calls must not carry on in sessions of their own
+        raise RuntimeError("Unit of work failed to commit") from (None if released.cancelled() else released.exception())
+    return None
+
+@asynccontextmanager
+async def unit_of_work(factory = None):
+    """
+    Opens one session for all db reads and writes made while handling an update.
+    Model calls made inside share its connection, everything is committed once at the end, or earlier
+    by release(), or rolled back on error. Nested units of work reuse the outer one.
+    """
+    ses = active_session()
+    if ses is not None:
+        yield ses
+        return
+    async with (factory or default_session)() as ses:
+        token = current_session.set(ses)
+        try:
+            yield ses
+            await ses.commit()
+            await run_after_commit(ses)
+        except BaseException:
+            await ses.rollback()
+            raise
+        finally:
+            current_session.reset(token)
+
+@asynccontextmanager
+async def scoped_session(factory):
+    "Yields session of the current unit of work, or a new session from the factory outside of it"
+    ses = active_session()
+    if ses is not None:
+        yield ses
+    else:
+        async with factory() as ses:
+            yield ses
+
+async def commit(ses) -> None:
+    "Commits a model call, changes made inside a unit of work are only flushed and committed with it"
+    if ses is active_session():
+        await ses.flush()
+    else:
+        await ses.commit()
+        await run_after_commit(ses)
+
+def after_commit(ses, callback) -> None:
+    """
+    Schedules callback to run once the session's changes are committed, by commit() or by the unit of work.
+    Callback may return an awaitable, it's awaited then.
+    """
+    ses.info.setdefault("after_commit", []).append(callback)
+
+async def run_after_commit(ses) -> None:
+    for callback in ses.info.pop("after_commit", []):
+        result = callback()
+        if isawaitable(result):
+            await result
+
+async def release() -> None:
+    """
+    Commits the current unit of work early, so its connection and row locks aren't held while waiting
+    on something slow, like rate limited Bot API requests. Model calls made afterwards use sessions
+    of their own. Concurrent callers, e.g. tasks of one update, wait for the same commit and get its error.
+    """
+    ses = current_session.get()
+    if ses is None:
+        return
+    released = ses.info.get("released")
+    if released is not None:
+        await asyncio.shield(released)
+        return
+    released = ses.info["released"] = asyncio.get_running_loop().create_future()
+    try:
+        await ses.commit()
+        await run_after_commit(ses)
+    except Exception as e:
+        released.set_exception(e)
+        # Marks the error retrieved, there may be no other callers to await it
+        released.exception()
+        raise
+    except BaseException:
+        released.cancel()
+        raise
+    released.set_result(None)
@@ -1,55 +1,97 @@
 from habbiton.models.state import Level, Message, Button
 from habbiton.models.user import User
 from habbiton.models.habit import Habit, HabitCompletion
-from habbiton import Base, engine, session
+from habbiton.models.reminder import ReminderLog
+from habbiton.models.schema import SchemaVersion
+from habbiton.migrations import migrate, LATEST_VERSION, LOCK_KEY
+from habbiton import Base, engine, session, cache, startup
+from habbiton.periods import local_today
 from datetime import date, timedelta
-from sqlalchemy import select
-async def fill_new_db():
+from sqlalchemy import select, insert, update, text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncEngine
+import argparse
+import asyncio
+#Version of bot's levels structure made by create_basic_state, startup seeds the db while it's behind
+SEED_VERSION = 1
+
+async def db_is_current(bind: AsyncEngine = engine) -> bool:
+    "Checks with a single row read whether schema and levels are up to date, so startup can skip the rest"
+    try:
+        async with bind.connect() as conn:
+            startup.timer.mark("db_connect")
+            row = (await conn.execute(select(SchemaVersion.version, SchemaVersion.seed_version))).first()
+    except ProgrammingError:
+        # Schema is too old to have the versions, or there's no schema at all
+        return False
+    return row is not None and row.version >= LATEST_VERSION and row.seed_version >= SEED_VERSION
+
+async def fill_new_db(bind: AsyncEngine = engine):
     """
-    Checks tables, creates if those are absent, also fills them with bot's levels structure
+    Checks tables, creates if those are absent, migrates existing ones, also fills them with bot's levels structure.
+    Does nothing but reading versions when db is up to date, otherwise only one instance at a time goes on.
     """
-    async with engine.begin() as conn:
+    if await db_is_current(bind):
+        startup.timer.mark("schema")
+        return
+
+    async with bind.begin() as conn:
+        # Instances waiting here find the work done, statements below change nothing then
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
         await conn.run_sync(Base.metadata.create_all)
-    
-    async with session() as ses:
-        stmt = select(Level)
-        levels = (await ses.execute(stmt)).scalars().all()
-        if len(levels) == 0:
-            await create_basic_state()
-    
+        await migrate(conn)
+        startup.timer.mark("schema")
 
-async def create_test_fixture(user_id):
+        seed_version = (await conn.execute(select(SchemaVersion.seed_version))).scalar()
+        if seed_version < SEED_VERSION:
+            if (await conn.execute(select(Level.name).limit(1))).first() is None:
+                await create_basic_state(conn)
+            await conn.execute(update(SchemaVersion).values(seed_version = SEED_VERSION))
+    await cache.backend.invalidate(cache.LEVELS_KEY)
+    startup.timer.mark("seed")
+
+#Habits of the in-app test fixture, their shapes are reused for benchmark data
+FIXTURE_HABITS = [
+    ("Drink enough water", "Daily", False),
+    ("Work out", "Daily", False),
+    ("Wash clothes", "Weekly", False),
+    ("Tidy the house", "Weekly", False),
+    ("Visit parents", "Monthly", True),
+]
+
+async def create_test_fixture(user_id, today = None):
     """
     Generates 5 predefined habits for user testing in-app, also generates track record for 4+ weeks
     """
-    today = date.today()
+    today = today or local_today()
     async with session() as ses:
-        h1 = Habit(name="Drink enough water", user_id=user_id, period = "Daily", created_date = date.today().replace(year=today.year - 1))
-        h2 = Habit(name="Work out", user_id=user_id, period = "Daily", created_date = date.today().replace(year=today.year - 1))
-        h3 = Habit(name="Wash clothes", user_id=user_id, period = "Weekly", created_date = date.today().replace(year=today.year - 1))
-        h4 = Habit(name="Tidy the house", user_id=user_id, period = "Weekly", created_date = date.today().replace(year=today.year - 1))
-        h5 = Habit(name="Visit parents", user_id=user_id, period = "Monthly", created_date = date.today().replace(year=today.year - 1), starred = True)
-        habits_list = [h1, h2, h3, h4, h5]
+        created_date = today.replace(year=today.year - 1)
+        habits_list = [
+            Habit(name=name, user_id=user_id, period=period, created_date=created_date, starred=starred)
+            for name, period, starred in FIXTURE_HABITS
+        ]
+        h1, h2, h3, h4, h5 = habits_list
         ses.add_all(habits_list)
         await ses.commit()
         for h in habits_list:
             await ses.refresh(h)
 
+        rows = []
         for i in range(1, 29):
-            ses.add(HabitCompletion(habit_id = h1.id, created_date = today - timedelta(days=i)))
+            rows.append({"habit_id": h1.id, "created_date": today - timedelta(days=i)})
 
         for i in range(1, 29):
             if i in [7, 22]:
                 continue
-            ses.add(HabitCompletion(habit_id = h2.id, created_date = today - timedelta(days=i)))
+            rows.append({"habit_id": h2.id, "created_date": today - timedelta(days=i)})
         
         for i in range(1, 5):
-            ses.add(HabitCompletion(habit_id = h3.id, created_date = today - timedelta(weeks=i)))
+            rows.append({"habit_id": h3.id, "created_date": today - timedelta(weeks=i)})
         
         for i in range(1, 5):
             if i in [2]:
                 continue
-            ses.add(HabitCompletion(habit_id = h4.id, created_date = today - timedelta(weeks=i)))
+            rows.append({"habit_id": h4.id, "created_date": today - timedelta(weeks=i)})
         
         for i in range(1, 6):
             if i in [5]:
@@ -60,12 +102,17 @@ async def create_test_fixture(user_id):
             else:
                 buffer = date(today.year - 1, 12 - i + 2, 1)
 
-            ses.add(HabitCompletion(habit_id = h5.id, created_date = buffer))
+            rows.append({"habit_id": h5.id, "created_date": buffer})
 
+        # One executemany instead of an insert per completion
+        await ses.execute(insert(HabitCompletion), rows)
         await ses.commit()
+    # Completions above bypass Habit.complete, so counters are calculated afterwards
+    await Habit.rebuild_counters(user_ids = [user_id])
+    await cache.backend.invalidate(cache.habits_key(user_id))
 
-async def create_basic_state():
-    async with session() as ses:
+async def create_basic_state(bind = engine):
+    async with session(bind = bind) as ses:
         ses.add(Level(name="start"))
         ses.add(Level(name="main"))
         ses.add(Level(name="new_habit", callback="get_habit_name"))
@@ -96,3 +143,13 @@ async def create_basic_state():
         ses.add(Button(current_level_name="new_habit_period", target_level_name= "new_habit", text="Back", callback="delete_unfinished_habit", order = 4))
         
         await ses.commit()
+
+def rebuild_streaks():
+    "Console entry point, rebuilds materialized streak counters of all habits from their completions"
+    parser = argparse.ArgumentParser(description = rebuild_streaks.__doc__)
+    parser.add_argument("--verify", action = "store_true", help = "only report habits with wrong counters, exit code is 1 if any")
+    args = parser.parse_args()
+    mismatched = asyncio.run(Habit.rebuild_counters(verify = args.verify))
+    print(f"{len(mismatched)} habits with wrong counters{'' if args.verify else ' rebuilt'}: {mismatched}")
+    if args.verify and mismatched:
+        raise SystemExit(1)
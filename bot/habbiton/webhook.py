@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import signal
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from habbiton import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SHUTDOWN_TIMEOUT
+from habbiton import startup
+
+logger = logging.getLogger(__name__)
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+class RequestHandler(SimpleRequestHandler):
+    "Handles updates in background tasks it keeps track of, so shutdown can wait for them"
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tasks: set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.handle_in_background:
+            return await super().handle(request)
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body = "Unauthorized", status = 401)
+        task = asyncio.create_task(self.feed(bot, await request.json(loads = bot.session.json_loads)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.json_response({}, dumps = bot.session.json_dumps)
+
+    async def feed(self, bot: Bot, update: dict) -> None:
+        result = await self.dispatcher.feed_raw_update(bot = bot, update = update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot = bot, result = result)
+
+def create_app(
+    dispatcher: Dispatcher,
+    bot: Bot,
+    path: str = WEBHOOK_PATH,
+    secret_token: str = WEBHOOK_SECRET,
+    handle_in_background: bool = True,
+    shutdown_timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT
+) -> web.Application:
+    """
+    Builds aiohttp app feeding updates posted by Telegram to the dispatcher.
+    Requests without matching secret token header are rejected, /health is served for probes.
+    Dispatcher startup and shutdown are not bound to the app, see serve(). Updates still handled
+    in background when the app shuts down are waited for up to shutdown_timeout, then cancelled.
+    """
+    app = web.Application()
+    handler = RequestHandler(
+        dispatcher = dispatcher,
+        bot = bot,
+        secret_token = secret_token,
+        handle_in_background = handle_in_background
+    )
+    handler.register(app, path = path)
+    app.router.add_get("/health", health)
+
+    async def finish_updates(app: web.Application) -> None:
+        # Runs once the site stopped accepting requests, so no new tasks appear
+        tasks = set(handler.tasks)
+        if not tasks:
+            return
+        logger.info(f"Waiting for {len(tasks)} updates being handled")
+        _, pending = await asyncio.wait(tasks, timeout = shutdown_timeout)
+        if pending:
+            logger.warning(f"Cancelling {len(pending)} updates not handled in {shutdown_timeout}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+    app.on_shutdown.append(finish_updates)
+    return app
+
+async def serve(dispatcher: Dispatcher, bot: Bot, allowed_updates: list[str] = None) -> None:
+    """
+    Registers webhook and serves updates until SIGINT/SIGTERM, then shuts down gracefully.
+    Telegram sends only update types the dispatcher handles, unless allowed_updates are given.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL should be set in webhook mode")
+
+    await dispatcher.emit_startup(bot = bot)
+    runner = web.AppRunner(create_app(dispatcher, bot))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token = WEBHOOK_SECRET,
+            allowed_updates = dispatcher.resolve_used_update_types() if allowed_updates is None else allowed_updates
+        )
+        logger.info(f"Serving webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        startup.timer.finish("webhook")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        # Webhook stays registered, Telegram keeps updates until the bot is back.
+        # Cleanup waits for updates being handled, so the dispatcher shuts down after them
+        logger.info("Stopping webhook server")
+        await runner.cleanup()
+        await dispatcher.emit_shutdown(bot = bot)